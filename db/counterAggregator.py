@@ -0,0 +1,218 @@
+import json
+import threading
+
+from common.db import periodicFlusher
+from common.log import logUtils as log
+from common.redis import batch
+from objects import glob
+
+
+class counterAggregator(periodicFlusher.periodicFlusher):
+	"""
+	Counters aggregator.
+	Accumulates counter increments (eg: `playcount = playcount + 1`) in memory or in a redis hash
+	and writes them to db periodically, with one multi-row query per table.
+	This way, the number of rows written depends on the number of distinct counters
+	changed in an interval rather than on the number of increments.
+
+	Counters are identified by table, key columns (eg: `{"user_id": 1000}`) and counter column.
+	Tables with `upsert=True` counters are written with `INSERT ... ON DUPLICATE KEY UPDATE`,
+	the other ones with a single `UPDATE ... CASE` query, so no rows are ever created.
+	"""
+	flushDescription = "counters"
+
+	def __init__(self, backend="memory", interval=10, redisKey="ripple:counters", chunkSize=500):
+		"""
+		Initialize a counters aggregator
+
+		:param backend: 	"memory" to accumulate increments in this process,
+							"redis" to accumulate them in a redis hash shared by all processes. Default: "memory"
+		:param interval: seconds between flushes. Default: 10
+		:param redisKey: name of the redis hash used by the redis backend. Default: ripple:counters
+		:param chunkSize: max rows per query. Default: 500
+		"""
+		if backend not in ("memory", "redis"):
+			raise ValueError("Unsupported counters backend ({})".format(backend))
+		super().__init__(interval, redisKey)
+		self.backend = backend
+		self.chunkSize = chunkSize
+		self.pending = {}
+		self.flushing = {}
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def _counterKey(table, key, upsert):
+		return table, tuple(sorted(key.items())), upsert
+
+	@staticmethod
+	def _redisField(counterKey, column):
+		table, keyItems, upsert = counterKey
+		return json.dumps([table, keyItems, upsert, column])
+
+	@staticmethod
+	def _parseRedisField(field):
+		table, keyItems, upsert, column = json.loads(field.decode("utf-8") if isinstance(field, bytes) else field)
+		return (table, tuple(tuple(x) for x in keyItems), upsert), column
+
+	def increment(self, table, key, deltas, upsert=True):
+		"""
+		Increment some counters
+
+		:param table: db table name
+		:param key: dictionary with the key columns and their values. Eg: `{"user_id": 1000}`
+		:param deltas: dictionary with the counter columns and their increments. Eg: `{"playcount": 1}`
+		:param upsert: if True, create the row if it doesn't exist. Default: True
+		:return:
+		"""
+		counterKey = self._counterKey(table, key, upsert)
+		if self.backend == "redis":
+			with batch.batch() as b:
+				for column, delta in deltas.items():
+					b.hincrby(self.redisKey, self._redisField(counterKey, column), delta)
+			return
+		with self.lock:
+			counters = self.pending.setdefault(counterKey, {})
+			for column, delta in deltas.items():
+				counters[column] = counters.get(column, 0) + delta
+
+	def getPending(self, table, key, columns, upsert=True):
+		"""
+		Return the increments that have not been written to db yet.
+		Add them to the values read from db to get up to date counters.
+
+		:param table: db table name
+		:param key: dictionary with the key columns and their values
+		:param columns: counter columns to return
+		:param upsert: same value passed to `increment`. Default: True
+		:return: dictionary with counter columns and pending increments
+		"""
+		counterKey = self._counterKey(table, key, upsert)
+		result = {x: 0 for x in columns}
+		if self.backend == "redis":
+			fields = [self._redisField(counterKey, x) for x in columns]
+			with batch.batch() as b:
+				b.hmget(self.redisKey, fields)
+				b.hmget(self.redisKey + ":flushing", fields)
+			for values in b.results:
+				for column, value in zip(columns, values):
+					if value is not None:
+						result[column] += int(value)
+			return result
+		with self.lock:
+			for source in (self.pending, self.flushing):
+				for column, delta in source.get(counterKey, {}).items():
+					if column in result:
+						result[column] += delta
+		return result
+
+	def _flush(self):
+		if self.backend == "redis":
+			self._flushRedis()
+		else:
+			self._flushMemory()
+
+	def _flushMemory(self):
+		with self.lock:
+			self.flushing, self.pending = self.pending, {}
+		committed = set()
+		try:
+			self._write(self.flushing, committed.update)
+		except:
+			# Put the increments that haven't been written back, they'll be written on next flush
+			with self.lock:
+				for counterKey, counters in self.flushing.items():
+					if counterKey in committed:
+						continue
+					pending = self.pending.setdefault(counterKey, {})
+					for column, delta in counters.items():
+						pending[column] = pending.get(column, 0) + delta
+			raise
+		finally:
+			with self.lock:
+				self.flushing = {}
+
+	def _flushRedis(self):
+		def write(raw, committed):
+			data = {}
+			fields = {}
+			for field, value in raw.items():
+				counterKey, column = self._parseRedisField(field)
+				data.setdefault(counterKey, {})[column] = int(value)
+				fields.setdefault(counterKey, []).append(field)
+			self._write(data, lambda counterKeys: committed([x for k in counterKeys for x in fields[k]]))
+		self._flushRedisHash(write)
+
+	def _write(self, data, onCommitted=None):
+		"""
+		Write some increments to db
+
+		:param data: dictionary with (table, key items, upsert) tuples as keys
+					and dictionaries with counter columns and increments as values
+		:param onCommitted: 	function called with the list of counter keys of every chunk
+								after it's been written. Default: None
+		:return:
+		"""
+		# Group rows that can be written with the same query.
+		# Zero increments are kept (adding 0 is harmless), so rows with some zero counters aren't split in more queries.
+		# `UPDATE ... CASE` rows are grouped by table and key columns only, counters missing from a row are incremented by 0.
+		groups = {}
+		for counterKey, counters in data.items():
+			table, keyItems, upsert = counterKey
+			if not any(counters.values()):
+				continue
+			keyColumns = tuple(x[0] for x in keyItems)
+			valueColumns = tuple(sorted(counters)) if upsert else None
+			group = groups.setdefault((table, keyColumns, valueColumns, upsert), {"columns": set(), "rows": []})
+			group["columns"].update(counters)
+			group["rows"].append((tuple(x[1] for x in keyItems), counters, counterKey))
+
+		for (table, keyColumns, _, upsert), group in groups.items():
+			valueColumns = tuple(sorted(group["columns"]))
+			rows = [(keyValues, tuple(counters.get(x, 0) for x in valueColumns), counterKey) for keyValues, counters, counterKey in group["rows"]]
+			for i in range(0, len(rows), self.chunkSize):
+				chunk = rows[i:i + self.chunkSize]
+				if upsert:
+					self._writeUpsert(table, keyColumns, valueColumns, chunk)
+				else:
+					self._writeUpdate(table, keyColumns, valueColumns, chunk)
+				if onCommitted is not None:
+					onCommitted([x[2] for x in chunk])
+			log.debug("Flushed {} counters rows to {}".format(len(rows), table))
+
+	@staticmethod
+	def _writeUpsert(table, keyColumns, valueColumns, rows):
+		columns = keyColumns + valueColumns
+		glob.db.execute(
+			"INSERT INTO {table} ({columns}) VALUES {values} ON DUPLICATE KEY UPDATE {updates}".format(
+				table=table,
+				columns=", ".join("`{}`".format(x) for x in columns),
+				values=", ".join(["({})".format(", ".join(["%s"] * len(columns)))] * len(rows)),
+				updates=", ".join("`{0}` = `{0}` + VALUES(`{0}`)".format(x) for x in valueColumns)
+			),
+			[x for keyValues, deltas, _ in rows for x in keyValues + deltas]
+		)
+
+	@staticmethod
+	def _writeUpdate(table, keyColumns, valueColumns, rows):
+		keyTuple = "({})".format(", ".join("`{}`".format(x) for x in keyColumns))
+		keyPlaceholder = "({})".format(", ".join(["%s"] * len(keyColumns)))
+		updates = []
+		params = []
+		for i, column in enumerate(valueColumns):
+			updates.append("`{0}` = `{0}` + CASE {1} ELSE 0 END".format(
+				column,
+				" ".join(["WHEN {} = {} THEN %s".format(keyTuple, keyPlaceholder)] * len(rows))
+			))
+			for keyValues, deltas, _ in rows:
+				params.extend(keyValues + (deltas[i],))
+		for keyValues, _, _ in rows:
+			params.extend(keyValues)
+		glob.db.execute(
+			"UPDATE {table} SET {updates} WHERE {key} IN ({keys})".format(
+				table=table,
+				updates=", ".join(updates),
+				key=keyTuple,
+				keys=", ".join([keyPlaceholder] * len(rows))
+			),
+			params
+		)
@@ -32,7 +32,7 @@ class db:
 				conn = objects.glob.threadScope.db
 				cur = conn.cursor(pymysql.cursors.DictCursor)
 
-				log.debug("{} ({})".format(query, params))
+				log.debug("%s (%s)", query, params)
 				cur.execute(query, params)
 				if callable(cb):
 					result = cb(cur)
@@ -43,11 +43,10 @@ class db:
 				break
 			except (pymysql.err.OperationalError, pymysql.err.InternalError) as e:
 				lastExc = e
-				log.error(
-					"MySQL operational/internal error on Thread {} ({}). Trying to recover".format(
-						threading.get_ident(),
-						e
-					)
+				log.errorLimited(
+					"MySQL operational/internal error on Thread {} ({}). Trying to recover",
+					threading.get_ident(),
+					e
 				)
 
 				# Close cursor now
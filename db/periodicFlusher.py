@@ -0,0 +1,113 @@
+import threading
+import uuid
+
+from common.log import logUtils as log
+from objects import glob
+
+
+class periodicFlusher:
+	"""
+	Base class for objects that accumulate data and write it to db periodically.
+	Subclasses implement `_flush`, that's called by `flush` with `self.flushLock` acquired.
+	"""
+	# Used in error messages
+	flushDescription = "pending data"
+
+	def __init__(self, interval, redisKey=None):
+		"""
+		Initialize a periodic flusher
+
+		:param interval: seconds between flushes
+		:param redisKey: name of the redis hash used by `_flushRedisHash`. Default: None
+		"""
+		self.interval = interval
+		self.redisKey = redisKey
+		self.flushLock = threading.Lock()
+		self.timer = None
+		self.running = False
+
+	def flush(self):
+		"""
+		Write all pending data to db
+
+		:return:
+		"""
+		with self.flushLock:
+			self._flush()
+
+	def _flush(self):
+		raise NotImplementedError()
+
+	def _flushRedisHash(self, write):
+		"""
+		Write the content of the redis hash `self.redisKey` to db.
+		The live hash is renamed before being written to db, so data received
+		during the flush goes to a new hash. If a process dies while flushing,
+		the renamed hash is still there and it's written on next flush.
+		Only one process at a time can flush, this is guaranteed by a lock key.
+
+		:param write: 	function called with the renamed hash content (dictionary) and a `committed` function.
+						`committed` must be called with the fields of every chunk written to db:
+						they're removed from the renamed hash, so a failed flush never writes them twice.
+		:return:
+		"""
+		flushingKey = self.redisKey + ":flushing"
+		lockKey = self.redisKey + ":lock"
+		lockTTL = max(60, self.interval * 6)
+		token = uuid.uuid4().hex
+		if not glob.redis.set(lockKey, token, nx=True, ex=lockTTL):
+			return
+		try:
+			if not glob.redis.exists(flushingKey) and glob.redis.exists(self.redisKey):
+				glob.redis.rename(self.redisKey, flushingKey)
+
+			def committed(fields):
+				if fields:
+					glob.redis.hdel(flushingKey, *fields)
+				# Keep the lock while writing big flushes, stop if another process took it
+				lockToken = glob.redis.get(lockKey)
+				if lockToken is None or lockToken.decode("utf-8") != token:
+					raise RuntimeError("Lost {} flush lock".format(self.flushDescription))
+				glob.redis.expire(lockKey, lockTTL)
+
+			write(glob.redis.hgetall(flushingKey), committed)
+			glob.redis.delete(flushingKey)
+		finally:
+			lockToken = glob.redis.get(lockKey)
+			if lockToken is not None and lockToken.decode("utf-8") == token:
+				glob.redis.delete(lockKey)
+
+	def start(self):
+		"""
+		Start writing pending data to db every `self.interval` seconds
+
+		:return:
+		"""
+		self.running = True
+		self.__scheduleFlush()
+
+	def stop(self):
+		"""
+		Stop the periodic flush and write all pending data to db
+
+		:return:
+		"""
+		self.running = False
+		if self.timer is not None:
+			self.timer.cancel()
+		self.flush()
+
+	def __scheduleFlush(self):
+		if not self.running:
+			return
+		self.timer = threading.Timer(self.interval, self.__flushLoop)
+		self.timer.daemon = True
+		self.timer.start()
+
+	def __flushLoop(self):
+		try:
+			self.flush()
+		except Exception as e:
+			log.error("Error while flushing {} ({}). Retrying on next flush.".format(self.flushDescription, e))
+		finally:
+			self.__scheduleFlush()
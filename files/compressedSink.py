@@ -0,0 +1,277 @@
+import gzip
+import os
+import zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+READ_SIZE = 1024 * 1024
+
+
+def compress(data, compression="gzip", level=6):
+	"""
+	Compress `data` as a single, self contained frame (a gzip member or a zstd frame).
+	Concatenated frames are still a valid gzip/zstd stream.
+
+	:param data: bytes or str (encoded as utf-8)
+	:param compression: "gzip" or "zstd". Default: "gzip"
+	:param level: compression level. Default: 6
+	:return: compressed frame
+	"""
+	if isinstance(data, str):
+		data = data.encode("utf-8")
+	if compression == "gzip":
+		return gzip.compress(data, compresslevel=level)
+	if compression == "zstd":
+		if zstandard is None:
+			raise ValueError("zstd compression requires the zstandard package")
+		return zstandard.ZstdCompressor(level=level).compress(data)
+	raise ValueError("Unsupported compression ({})".format(compression))
+
+def decompressor(compression):
+	"""
+	Return a new decompression object, that exposes `decompress` and `unused_data`
+
+	:param compression: "gzip" or "zstd"
+	:return: decompression object
+	"""
+	if compression == "gzip":
+		return zlib.decompressobj(wbits=31)
+	if compression == "zstd":
+		if zstandard is None:
+			raise ValueError("zstd files require the zstandard package")
+		return zstandard.ZstdDecompressor().decompressobj()
+	raise ValueError("Unsupported compression ({})".format(compression))
+
+
+class compressedSink:
+	"""
+	Compressed file writer.
+	Every `write` appends a self contained frame, so everything written before a crash stays readable.
+	Frames are listed in a sidecar index (`<fileName>.frames`, one `offset compressedSize uncompressedSize` line per frame),
+	that lets `compressedReader` jump to any frame without decompressing the previous ones.
+	"""
+	def __init__(self, fileName, compression="gzip", level=None):
+		"""
+		Initialize a compressed sink
+
+		:param fileName: file name
+		:param compression: "gzip" or "zstd". Default: "gzip"
+		:param level: compression level. Default: 6 for gzip, 3 for zstd
+		"""
+		if compression not in ("gzip", "zstd"):
+			raise ValueError("Unsupported compression ({})".format(compression))
+		if compression == "zstd" and zstandard is None:
+			raise ValueError("zstd compression requires the zstandard package")
+		self.fileName = fileName
+		self.compression = compression
+		self.level = level if level is not None else (6 if compression == "gzip" else 3)
+		self.file = None
+		self.index = None
+
+	def open(self, truncate=False):
+		"""
+		Open the file for appending
+
+		:param truncate: if True, empty the file and its index first. Default: False
+		:return: file object
+		"""
+		mode = "wb" if truncate else "ab"
+		self.file = open(self.fileName, mode)
+		self.index = open(self.fileName + ".frames", mode.replace("b", ""))
+		return self.file
+
+	def write(self, data):
+		"""
+		Compress `data` and append it to the file as a new frame
+
+		:param data: bytes or str (encoded as utf-8)
+		:return: compressed frame size
+		"""
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		if self.file is None:
+			self.open()
+		offset = self.file.seek(0, os.SEEK_END)
+		frame = compress(data, self.compression, self.level)
+		self.file.write(frame)
+		self.file.flush()
+		# The index is written after the frame, readers find unindexed frames by scanning the file
+		self.index.write("{} {} {}\n".format(offset, len(frame), len(data)))
+		self.index.flush()
+		return len(frame)
+
+	def flush(self):
+		"""
+		Flush the file and its index
+
+		:return:
+		"""
+		if self.file is not None:
+			self.file.flush()
+			self.index.flush()
+
+	def fileno(self):
+		"""
+		Return the file descriptor, so the sink can be locked with `fcntl.flock`
+
+		:return: file descriptor
+		"""
+		return self.file.fileno()
+
+	def close(self):
+		"""
+		Close the file and its index
+
+		:return:
+		"""
+		if self.file is not None:
+			self.file.close()
+			self.index.close()
+			self.file = None
+			self.index = None
+
+
+class compressedReader:
+	"""
+	Streaming reader for files written by `compressedSink` (or any concatenation of gzip members/zstd frames)
+	"""
+	def __init__(self, fileName, compression=None):
+		"""
+		Initialize a compressed reader
+
+		:param fileName: file name
+		:param compression: "gzip", "zstd" or None to detect it from the file content. Default: None
+		"""
+		self.fileName = fileName
+		if compression is None:
+			with open(fileName, "rb") as f:
+				compression = "zstd" if f.read(4) == ZSTD_MAGIC else "gzip"
+		self.compression = compression
+		self._frames = None
+
+	def frames(self):
+		"""
+		Return the frames in the file.
+		Frames are read from the index. Frames missing from the index (eg: the process died
+		after writing a frame but before indexing it) are found by scanning the gaps between indexed frames
+		and the end of the file. A truncated last frame is ignored.
+
+		:return: list of (offset, compressed size, uncompressed size) tuples
+		"""
+		if self._frames is not None:
+			return self._frames
+		frames = []
+		fileSize = os.path.getsize(self.fileName)
+		indexName = self.fileName + ".frames"
+		offset = 0
+		if os.path.exists(indexName):
+			with open(indexName, "r") as f:
+				for line in f:
+					parts = line.split()
+					if len(parts) != 3:
+						break
+					frame = tuple(int(x) for x in parts)
+					if frame[0] < offset or frame[0] + frame[1] > fileSize:
+						# Inconsistent index, scan the rest of the file
+						break
+					if frame[0] > offset:
+						frames.extend(self.__scan(offset, frame[0]))
+					frames.append(frame)
+					offset = frame[0] + frame[1]
+		if offset < fileSize:
+			frames.extend(self.__scan(offset, fileSize))
+		self._frames = frames
+		return frames
+
+	def __scan(self, offset, end):
+		# Find the frames between `offset` and `end`, reading the file in blocks
+		frames = []
+		decompressObj = None
+		frameStart = offset
+		size = 0
+		data = b""
+		with open(self.fileName, "rb") as f:
+			f.seek(offset)
+			while True:
+				if not data:
+					data = f.read(min(READ_SIZE, end - offset))
+					if not data:
+						break
+				if decompressObj is None:
+					decompressObj = decompressor(self.compression)
+					frameStart = offset
+					size = 0
+				try:
+					size += len(decompressObj.decompress(data))
+				except Exception:
+					# Corrupted data
+					break
+				if decompressObj.eof:
+					remaining = decompressObj.unused_data
+					offset += len(data) - len(remaining)
+					frames.append((frameStart, offset - frameStart, size))
+					decompressObj = None
+					data = remaining
+				else:
+					offset += len(data)
+					data = b""
+		return frames
+
+	def readFrame(self, i):
+		"""
+		Read and decompress a frame
+
+		:param i: frame number
+		:return: decompressed frame, as bytes
+		"""
+		offset, size, _ = self.frames()[i]
+		with open(self.fileName, "rb") as f:
+			f.seek(offset)
+			return decompressor(self.compression).decompress(f.read(size))
+
+	def iterFrames(self, start=0):
+		"""
+		Yield decompressed frames, starting from frame `start`
+
+		:param start: first frame number. Default: 0
+		:return: generator of bytes
+		"""
+		frames = self.frames()
+		with open(self.fileName, "rb") as f:
+			for offset, size, _ in frames[start:]:
+				f.seek(offset)
+				yield decompressor(self.compression).decompress(f.read(size))
+
+	def frameAt(self, uncompressedOffset):
+		"""
+		Return the frame that contains an uncompressed byte offset
+
+		:param uncompressedOffset: offset in decompressed data
+		:return: (frame number, offset of the frame in decompressed data) or None if it's past the end
+		"""
+		position = 0
+		for i, (_, _, size) in enumerate(self.frames()):
+			if uncompressedOffset < position + size:
+				return i, position
+			position += size
+		return None
+
+	def iterLines(self, start=0):
+		"""
+		Yield decoded lines, starting from frame `start`
+
+		:param start: first frame number. Default: 0
+		:return: generator of str
+		"""
+		rest = b""
+		for data in self.iterFrames(start):
+			lines = (rest + data).split(b"\n")
+			rest = lines.pop()
+			for line in lines:
+				yield line.decode("utf-8") + "\n"
+		if rest:
+			yield rest.decode("utf-8")
@@ -1,23 +1,69 @@
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+import weakref
+
+from common.files import compressedSink
 from objects import glob
 
 class buffer:
 	"""
 	A file buffer object.
-	This buffer caches data in memory and when it's full, it writes the content to a file.
+	This buffer caches data in memory and writes it to a file when it's full or old enough.
+	Writes only append to an in-memory list of chunks, the file is written by a background flusher thread
+	that keeps the file open between flushes.
 	"""
-	def __init__(self, fileName, writeType="a", maxLength=512):
+	def __init__(self, fileName, writeType="a", maxLength=512, maxAge=1, fsync=None, background=True, compression=None, encoding=None):
 		"""
 		A file buffer object
 
 		:param fileName: Path and name of file on disk .
 		:param writeType: File write type. Optional. Default: "a" .
 		:param maxLength: Max length before writing buffer to disk. Optional. Default: 512.
+		:param maxAge: 	Max seconds data stays in buffer before being written to disk.
+						None = write only when the buffer is full. Optional. Default: 1.
+		:param fsync: 	fsync policy. None = never fsync, 0 = fsync after every flush,
+						N = fsync at most once every N seconds. Optional. Default: None.
+		:param background: 	If True, full and old buffers are written by the background flusher thread.
+							If False, a full buffer is written by the thread that fills it. Optional. Default: True.
+		:param compression: 	"gzip" or "zstd" to write every flush as a compressed frame (see common.files.compressedSink),
+								None to write plain text. Optional. Default: None.
+		:param encoding: 	text encoding of the file. Ignored for compressed files, that are always utf-8.
+							None = locale encoding. Optional. Default: None.
 		"""
-		self.content = ""
+		self.chunks = []
 		self.length = 0
 		self.fileName = fileName
 		self.writeType = writeType
 		self.maxLength = maxLength
+		self.maxAge = maxAge
+		self.fsync = fsync
+		self.background = background
+		self.encoding = encoding
+		self.firstWrite = None
+		self.lastFsync = time.monotonic()
+		self.file = None
+		self.sink = compressedSink.compressedSink(fileName, compression) if compression is not None else None
+		# Called with this buffer after its file is opened and after every write to disk
+		self.onOpen = None
+		self.onFlush = None
+		self.lock = threading.Lock()
+		self.flushLock = threading.Lock()
+		if self.background:
+			flusher.register(self)
+
+	@property
+	def content(self):
+		"""
+		Data in buffer, not written to disk yet
+
+		:return: buffered data
+		"""
+		with self.lock:
+			return "".join(self.chunks)
 
 	def write(self, newData):
 		"""
@@ -28,10 +74,30 @@ class buffer:
 		:param newData: Data to append to buffer
 		:return:
 		"""
-		self.content += newData
-		self.length += len(newData)
+		with self.lock:
+			self.chunks.append(newData)
+			self.length += len(newData)
+			if self.firstWrite is None:
+				self.firstWrite = time.monotonic()
+			full = self.length >= self.maxLength
+		if full:
+			if self.background:
+				flusher.wake()
+			else:
+				self.flush()
+
+	def shouldFlush(self, now=None):
+		"""
+		Check if this buffer is full or older than self.maxAge
+
+		:param now: `time.monotonic()` value. Default: current value
+		:return: True if the buffer should be written to disk
+		"""
 		if self.length >= self.maxLength:
-			self.flush()
+			return True
+		if self.maxAge is None or self.firstWrite is None:
+			return False
+		return (now if now is not None else time.monotonic()) - self.firstWrite >= self.maxAge
 
 	def flush(self):
 		"""
@@ -39,35 +105,232 @@ class buffer:
 
 		:return:
 		"""
+		with self.flushLock:
+			with self.lock:
+				chunks = self.chunks
+				self.chunks = []
+				self.length = 0
+				self.firstWrite = None
+			if not chunks:
+				return
+			try:
+				if self.file is None:
+					if self.sink is not None:
+						self.file = self.sink.open(truncate=self.writeType.startswith("w"))
+					else:
+						self.file = open(self.fileName, self.writeType, encoding=self.encoding)
+					# Never truncate the file again if it's reopened after being closed
+					if self.writeType.startswith("w"):
+						self.writeType = "a" + self.writeType[1:]
+					if self.onOpen is not None:
+						self.onOpen(self)
+				# Lock the file for other threads and processes while writing
+				with glob.fLocks.locked(self.fileName, self.file):
+					if self.sink is not None:
+						self.sink.write("".join(chunks))
+					else:
+						self.file.write("".join(chunks))
+						self.file.flush()
+				if self.fsync is not None and time.monotonic() - self.lastFsync >= self.fsync:
+					os.fsync(self.file.fileno())
+					self.lastFsync = time.monotonic()
+				if self.onFlush is not None:
+					self.onFlush(self)
+			except:
+				# Put data back in buffer, so it's written on next flush
+				with self.lock:
+					self.chunks = chunks + self.chunks
+					self.length += sum(len(x) for x in chunks)
+					if self.firstWrite is None:
+						self.firstWrite = time.monotonic()
+				raise
+
+	def close(self):
+		"""
+		Write buffer content to disk and close the file.
+		The file is opened again on next flush.
+
+		:return:
+		"""
+		self.flush()
+		self.closeFile()
+
+	def closeFile(self, blocking=True):
+		"""
+		Close the file, without writing buffer content.
+		The file is opened again on next flush.
+
+		:param blocking: 	if False, don't wait if the buffer is being flushed by another thread.
+							Optional. Default: True.
+		:return: True if the file is closed, False if the buffer was busy
+		"""
+		if not self.flushLock.acquire(blocking):
+			return False
 		try:
-			glob.fLocks.lockFile(self.fileName)
-			with open(self.fileName, self.writeType) as f:
-				f.write(self.content)
+			if self.file is not None:
+				if self.fsync is not None:
+					os.fsync(self.file.fileno())
+				if self.sink is not None:
+					self.sink.close()
+				else:
+					self.file.close()
+				self.file = None
+			return True
 		finally:
-			glob.fLocks.unlockFile(self.fileName)
+			self.flushLock.release()
 
-		self.content = ""
-		self.length = 0
+class backgroundFlusher:
+	"""
+	Thread that writes full or old buffers to disk
+	"""
+	def __init__(self, interval=0.5):
+		"""
+		Initialize a background flusher
+
+		:param interval: seconds between two checks of buffers age. Default: 0.5
+		"""
+		self.interval = interval
+		self.buffers = weakref.WeakSet()
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.thread = None
+
+	def register(self, b):
+		"""
+		Start flushing `b` in background
+
+		:param b: buffer object
+		:return:
+		"""
+		with self.lock:
+			self.buffers.add(b)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.__flushLoop, name="fileBufferFlusher", daemon=True)
+				self.thread.start()
+
+	def unregister(self, b):
+		"""
+		Stop flushing `b` in background
+
+		:param b: buffer object
+		:return:
+		"""
+		with self.lock:
+			self.buffers.discard(b)
+
+	def wake(self):
+		"""
+		Check the buffers now, without waiting for the next interval
+
+		:return:
+		"""
+		self.event.set()
+
+	def flushAll(self):
+		"""
+		Write all registered buffers to disk
+
+		:return:
+		"""
+		with self.lock:
+			buffers = list(self.buffers)
+		for b in buffers:
+			b.flush()
+
+	def __flushLoop(self):
+		while True:
+			self.event.wait(self.interval)
+			self.event.clear()
+			now = time.monotonic()
+			with self.lock:
+				buffers = [x for x in self.buffers if x.shouldFlush(now)]
+			for b in buffers:
+				try:
+					b.flush()
+				except Exception as e:
+					logging.error("Error while flushing file buffer {} ({})".format(b.fileName, e))
+
+flusher = backgroundFlusher()
+atexit.register(flusher.flushAll)
 
 class buffersList:
 	"""
-	A list of buffers
+	A list of buffers.
+	Keeps at most `maxOpenFiles` files open (least recently used files are closed first),
+	and at most `maxBufferedBytes` of data in memory: when the budget is exceeded,
+	the writer that exceeds it writes the biggest buffers to disk before returning.
+	Buffers not written for `maxIdle` seconds are flushed and removed.
 	"""
-	def __init__(self):
-		self.buffers = {}
+	def __init__(self, maxBufferedBytes=16*1024*1024, maxOpenFiles=128, maxBuffers=4096, maxIdle=300, **bufferKwargs):
+		"""
+		Initialize a list of buffers
+
+		:param maxBufferedBytes: max data in all buffers. Default: 16 MiB
+		:param maxOpenFiles: max open files. Default: 128
+		:param maxBuffers: max buffers. Least recently written buffers are evicted first. Default: 4096
+		:param maxIdle: seconds after which a buffer that's not written is evicted. None = never. Default: 300
+		:param bufferKwargs: arguments passed to every new `buffer`
+		"""
+		self.buffers = collections.OrderedDict()
+		self.lastWrite = {}
+		self.openFiles = collections.OrderedDict()
+		self.maxBufferedBytes = maxBufferedBytes
+		self.maxOpenFiles = maxOpenFiles
+		self.maxBuffers = maxBuffers
+		self.maxIdle = maxIdle
+		self.bufferKwargs = bufferKwargs
+		self.bufferedBytes = 0
+		self.lastIdleCheck = time.monotonic()
+		self.lock = threading.RLock()
+		self.stats = {
+			"evictions": 0,
+			"fdEvictions": 0,
+			"backpressureFlushes": 0
+		}
 
 	def write(self, fileName, content):
 		"""
 		Write some data to an existing buffer in this list (or create a new one if it doesn't exist).
 		If the buffer is full, the data is written to the file and the buffer resets.
+		If the memory budget is exceeded, the biggest buffers are written to disk before returning.
 
 		:param fileName: Path of file/buffer
 		:param content: New content
 		:return:
 		"""
-		if fileName not in self.buffers:
-			self.buffers[fileName] = buffer(fileName)
-		self.buffers[fileName].write(content)
+		now = time.monotonic()
+		evicted = None
+		with self.lock:
+			b = self.buffers.get(fileName)
+			if b is None:
+				b = buffer(fileName, **self.bufferKwargs)
+				b.onOpen = self.__fileUsed
+				b.onFlush = self.__fileUsed
+				self.buffers[fileName] = b
+				if len(self.buffers) > self.maxBuffers:
+					evicted = self.__detach(next(iter(self.buffers)))
+			else:
+				self.buffers.move_to_end(fileName)
+				if fileName in self.openFiles:
+					self.openFiles.move_to_end(fileName)
+			self.lastWrite[fileName] = now
+			# Estimate, it's recomputed when it goes over the budget
+			self.bufferedBytes += len(content)
+			overBudget = self.bufferedBytes > self.maxBufferedBytes
+		# Disk I/O is never done with self.lock acquired, so writers don't wait for each other
+		if evicted is not None:
+			evicted.close()
+		b.write(content)
+		with self.lock:
+			detached = self.buffers.get(fileName) is not b
+		if detached:
+			# Evicted by another thread while writing, the eviction may have closed it before our write
+			b.close()
+		if overBudget:
+			self.__applyBackpressure()
+		if self.maxIdle is not None and now - self.lastIdleCheck >= min(self.maxIdle, 10):
+			self.lastIdleCheck = now
+			self.evictIdle()
 
 	def flushAll(self):
 		"""
@@ -75,5 +338,92 @@ class buffersList:
 
 		:return:
 		"""
-		for _, value in self.buffers.items():
-			value.flush()
\ No newline at end of file
+		with self.lock:
+			buffers = list(self.buffers.values())
+		for value in buffers:
+			value.flush()
+
+	def evictIdle(self, maxIdle=None):
+		"""
+		Flush and remove the buffers that haven't been written for `maxIdle` seconds
+
+		:param maxIdle: seconds. Default: self.maxIdle
+		:return: number of evicted buffers
+		"""
+		if maxIdle is None:
+			maxIdle = self.maxIdle
+		now = time.monotonic()
+		evicted = []
+		with self.lock:
+			# Buffers are sorted by last write, oldest first
+			for fileName in list(self.buffers):
+				if now - self.lastWrite[fileName] < maxIdle:
+					break
+				evicted.append(self.__detach(fileName))
+		for b in evicted:
+			b.close()
+		return len(evicted)
+
+	def getStats(self):
+		"""
+		Return buffers statistics
+
+		:return: dictionary with `buffers`, `openFiles`, `bufferedBytes`, `evictions`,
+				`fdEvictions` and `backpressureFlushes` keys
+		"""
+		with self.lock:
+			stats = dict(self.stats)
+			stats["buffers"] = len(self.buffers)
+			stats["openFiles"] = len(self.openFiles)
+			stats["bufferedBytes"] = sum(x.length for x in self.buffers.values())
+		return stats
+
+	def __detach(self, fileName):
+		# Remove a buffer from this list, with self.lock acquired.
+		# The caller must close the returned buffer after releasing self.lock.
+		b = self.buffers.pop(fileName)
+		self.lastWrite.pop(fileName, None)
+		self.openFiles.pop(fileName, None)
+		b.onOpen = None
+		b.onFlush = None
+		flusher.unregister(b)
+		self.stats["evictions"] += 1
+		return b
+
+	def __applyBackpressure(self):
+		with self.lock:
+			self.bufferedBytes = sum(x.length for x in self.buffers.values())
+			if self.bufferedBytes <= self.maxBufferedBytes:
+				return
+			buffers = sorted(self.buffers.values(), key=lambda x: x.length, reverse=True)
+		for b in buffers:
+			length = b.length
+			b.flush()
+			with self.lock:
+				self.stats["backpressureFlushes"] += 1
+				self.bufferedBytes -= length
+				if self.bufferedBytes <= self.maxBufferedBytes:
+					break
+
+	def __fileUsed(self, b):
+		# Called by the thread that's flushing `b`, with `b.flushLock` acquired,
+		# when the file is opened and after every write, to keep open files sorted by last use
+		with self.lock:
+			if self.buffers.get(b.fileName) is not b:
+				# Evicted while being flushed
+				return
+			self.openFiles[b.fileName] = b
+			self.openFiles.move_to_end(b.fileName)
+			toClose = len(self.openFiles) - self.maxOpenFiles
+			if toClose <= 0:
+				return
+			candidates = [x for x in self.openFiles.values() if x is not b]
+		for other in candidates:
+			if toClose <= 0:
+				break
+			# Don't wait for buffers that are being flushed by other threads, to avoid deadlocks
+			if other.closeFile(blocking=False):
+				with self.lock:
+					self.openFiles.pop(other.fileName, None)
+					self.stats["fdEvictions"] += 1
+				toClose -= 1
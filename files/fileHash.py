@@ -0,0 +1,187 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+# Files bigger than this are hashed through mmap when hashlib.file_digest is not available
+MMAP_THRESHOLD = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+SUPPORTED_ALGORITHMS = ("md5", "sha256")
+
+
+class digestCache:
+	"""
+	LRU cache of file digests.
+	Digests are keyed by path, size, modification time and inode, so a changed file is always hashed again.
+	"""
+	def __init__(self, maxSize=10000):
+		"""
+		Initialize a digest cache
+
+		:param maxSize: max cached digests. Default: 10000
+		"""
+		self.maxSize = maxSize
+		self.digests = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(path, algorithm, st=None):
+		"""
+		Return the cache key of a file
+
+		:param path: file path
+		:param algorithm: hash algorithm
+		:param st: `os.stat` result, if already available. Default: None
+		:return: cache key
+		"""
+		if st is None:
+			st = os.stat(path)
+		return os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino, algorithm
+
+	def get(self, key):
+		"""
+		Return a cached digest
+
+		:param key: cache key
+		:return: hex digest or None if it's not cached
+		"""
+		with self.lock:
+			digest = self.digests.get(key)
+			if digest is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.digests.move_to_end(key)
+			return digest
+
+	def set(self, key, digest):
+		"""
+		Cache a digest
+
+		:param key: cache key
+		:param digest: hex digest
+		:return:
+		"""
+		with self.lock:
+			self.digests[key] = digest
+			self.digests.move_to_end(key)
+			while len(self.digests) > self.maxSize:
+				self.digests.popitem(last=False)
+
+	def save(self, fileName):
+		"""
+		Save the cache to a json file
+
+		:param fileName: file name
+		:return:
+		"""
+		with self.lock:
+			entries = [list(k) + [v] for k, v in self.digests.items()]
+		temp = fileName + ".tmp"
+		with open(temp, "w") as f:
+			json.dump(entries, f)
+		os.replace(temp, fileName)
+
+	def load(self, fileName):
+		"""
+		Load the cache from a json file saved with `save`. Does nothing if the file doesn't exist.
+
+		:param fileName: file name
+		:return:
+		"""
+		if not os.path.exists(fileName):
+			return
+		with open(fileName, "r") as f:
+			entries = json.load(f)
+		for entry in entries:
+			self.set(tuple(entry[:-1]), entry[-1])
+
+
+cache = digestCache()
+
+
+def digestFile(path, algorithm="md5"):
+	"""
+	Hash a file, without using the cache
+
+	:param path: file path
+	:param algorithm: "md5" or "sha256". Default: "md5"
+	:return: hex digest
+	"""
+	if algorithm not in SUPPORTED_ALGORITHMS:
+		raise ValueError("Unsupported hash algorithm ({})".format(algorithm))
+	with open(path, "rb") as f:
+		if hasattr(hashlib, "file_digest"):
+			# Python 3.11+, reads and hashes in C
+			return hashlib.file_digest(f, algorithm).hexdigest()
+		d = hashlib.new(algorithm)
+		size = os.fstat(f.fileno()).st_size
+		if size >= MMAP_THRESHOLD:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				d.update(m)
+			return d.hexdigest()
+		buf = bytearray(READ_SIZE)
+		view = memoryview(buf)
+		while True:
+			n = f.readinto(buf)
+			if not n:
+				break
+			d.update(view[:n])
+	return d.hexdigest()
+
+def hashFile(path, algorithm="md5", useCache=True):
+	"""
+	Hash a file. Unchanged files are hashed only once.
+
+	:param path: file path
+	:param algorithm: "md5" or "sha256". Default: "md5"
+	:param useCache: if False, always hash the file. Default: True
+	:return: hex digest
+	"""
+	if not useCache:
+		return digestFile(path, algorithm)
+	key = cache.key(path, algorithm)
+	digest = cache.get(key)
+	if digest is None:
+		digest = digestFile(path, algorithm)
+		cache.set(key, digest)
+	return digest
+
+def hashDirectory(directory, algorithm="md5", recursive=True, processes=None):
+	"""
+	Hash all files in a directory. Files that are not cached are hashed in parallel by a process pool.
+
+	:param directory: directory path
+	:param algorithm: "md5" or "sha256". Default: "md5"
+	:param recursive: if True, hash files in subdirectories too. Default: True
+	:param processes: number of processes. Default: number of CPUs
+	:return: dictionary with file paths as keys and hex digests as values
+	"""
+	results = {}
+	missing = {}
+	for root, dirs, files in os.walk(directory):
+		for name in files:
+			path = os.path.join(root, name)
+			try:
+				key = cache.key(path, algorithm)
+			except OSError:
+				continue
+			digest = cache.get(key)
+			if digest is None:
+				missing[path] = key
+			else:
+				results[path] = digest
+		if not recursive:
+			break
+	if missing:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+			paths = list(missing)
+			for path, digest in zip(paths, executor.map(digestFile, paths, [algorithm] * len(paths), chunksize=16)):
+				cache.set(missing[path], digest)
+				results[path] = digest
+	return results
@@ -1,32 +1,121 @@
+import contextlib
 import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
 
 class fileLocks:
-	def __init__(self):
-		# Dictionary containing threading.Lock s
-		self.locks = {}
+	"""
+	File locks manager.
+	Files are mapped to a fixed number of striped locks (hash of the file name -> lock),
+	so locks are never created on the fly and their number doesn't grow with the number of files.
+	If an open file is passed, it's locked with `fcntl.flock` too, so writers in other processes are excluded as well.
+	"""
+	def __init__(self, stripes=64, interProcess=True, maxTrackedFiles=1000):
+		"""
+		Initialize a file locks manager
+
+		:param stripes: number of locks. Default: 64
+		:param interProcess: 	if True, lock the open files passed to `lockFile` with `fcntl.flock`.
+								Ignored where fcntl is not available. Default: True
+		:param maxTrackedFiles: max files with contention statistics. Default: 1000
+		"""
+		self.locks = [threading.RLock() for _ in range(stripes)]
+		self.interProcess = interProcess and fcntl is not None
+		self.maxTrackedFiles = maxTrackedFiles
+		self.statsLock = threading.Lock()
+		self.acquisitions = 0
+		self.contentions = {}
+
+	def getLock(self, fileName):
+		"""
+		Return the lock used for `fileName`
 
-	def lockFile(self, fileName):
+		:param fileName: file name
+		:return: threading.RLock object
+		"""
+		return self.locks[hash(fileName) % len(self.locks)]
+
+	def lockFile(self, fileName, f=None):
 		"""
 		Set a file as locked.
 
 		:param fileName: file name
+		:param f: 	open file object or file descriptor. If passed, the file is locked
+					for other processes too. Default: None
 		:return:
 		"""
-		if fileName in self.locks:
-			# Acquire existing lock
-			self.locks[fileName].acquire()
+		lock = self.getLock(fileName)
+		if lock.acquire(blocking=False):
+			with self.statsLock:
+				self.acquisitions += 1
 		else:
-			# Create new lock and acquire it
-			self.locks[fileName] = threading.Lock()
-			self.locks[fileName].acquire()
+			start = time.perf_counter()
+			lock.acquire()
+			self.__recordContention(fileName, time.perf_counter() - start)
+		if f is not None and self.interProcess:
+			try:
+				fcntl.flock(f, fcntl.LOCK_EX)
+			except:
+				lock.release()
+				raise
 
-	def unlockFile(self, fileName):
+	def unlockFile(self, fileName, f=None):
 		"""
 		Unlock a previously locked file
 
 		:param fileName: file name
+		:param f: the same open file object or file descriptor passed to `lockFile`. Default: None
+		:return:
+		"""
+		try:
+			if f is not None and self.interProcess:
+				fcntl.flock(f, fcntl.LOCK_UN)
+		finally:
+			self.getLock(fileName).release()
+
+	@contextlib.contextmanager
+	def locked(self, fileName, f=None):
+		"""
+		Context manager that locks a file.
+		```
+		with glob.fLocks.locked(fileName, f):
+			f.write(...)
+		```
+
+		:param fileName: file name
+		:param f: open file object or file descriptor, see `lockFile`. Default: None
 		:return:
 		"""
-		if fileName in self.locks:
-			# Release lock if it exists
-			self.locks[fileName].release()
+		self.lockFile(fileName, f)
+		try:
+			yield
+		finally:
+			self.unlockFile(fileName, f)
+
+	def getStats(self):
+		"""
+		Return contention statistics
+
+		:return: dictionary with `acquisitions` (total) and `contentions`
+				(file names as keys and dictionaries with `count` and `waitTime` in seconds as values)
+		"""
+		with self.statsLock:
+			return {
+				"acquisitions": self.acquisitions,
+				"contentions": {k: dict(v) for k, v in self.contentions.items()}
+			}
+
+	def __recordContention(self, fileName, waitTime):
+		with self.statsLock:
+			self.acquisitions += 1
+			stats = self.contentions.get(fileName)
+			if stats is None:
+				if len(self.contentions) >= self.maxTrackedFiles:
+					return
+				stats = self.contentions[fileName] = {"count": 0, "waitTime": 0.0}
+			stats["count"] += 1
+			stats["waitTime"] += waitTime
@@ -1,12 +1,12 @@
 import string
 import random
 import hashlib
-from functools import partial
 from common.log import logUtils as log
 
 import dill
 
 from common.constants import mods
+from common.files import fileHash
 from time import localtime, strftime
 
 def randomString(length = 8):
@@ -23,16 +23,13 @@ def stringToBool(s):
 
 def fileMd5(filename):
 	"""
-	Return filename's md5
+	Return filename's md5.
+	Unchanged files are hashed only once, see common.files.fileHash
 
 	:param filename: name of the file
 	:return: file md5
 	"""
-	with open(filename, mode='rb') as f:
-		d = hashlib.md5()
-		for buf in iter(partial(f.read, 128), b''):
-			d.update(buf)
-	return d.hexdigest()
+	return fileHash.hashFile(filename, "md5")
 
 def stringMd5(s):
 	"""
@@ -0,0 +1,170 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+
+class alertGroup:
+	__slots__ = ("channel", "key", "summary", "windowStart", "sent", "count", "items", "message")
+
+	def __init__(self, channel, key, summary, windowStart):
+		self.channel = channel
+		self.key = key
+		self.summary = summary
+		self.windowStart = windowStart
+		self.sent = False
+		self.count = 0
+		self.items = []
+		# First alert that was not sent right away
+		self.message = None
+
+
+class alertCoalescer:
+	"""
+	Coalesces alerts before sending them.
+	Alerts with the same channel and key in the same window are grouped:
+	the first one is sent right away, the others are summarized in a single digest at the end of the window,
+	eg: "36 more users auto-restricted in last 60s: **a** (1000), **b** (1001), ..."
+	Each channel can send at most `maxPerWindow` alerts right away per window, the others go to the digests.
+	Alerts are sent by a background thread, so the caller never waits for the webhook.
+	"""
+	def __init__(self, sendFunction, window=60, maxPerWindow=10, maxDigestItems=20):
+		"""
+		Initialize an alert coalescer
+
+		:param sendFunction: function that sends an alert, called with (channel, message)
+		:param window: seconds during which alerts with the same key are grouped. Default: 60
+		:param maxPerWindow: max alerts sent right away per channel in `window` seconds. Default: 10
+		:param maxDigestItems: max items listed in a digest. Default: 20
+		"""
+		self.sendFunction = sendFunction
+		self.window = window
+		self.maxPerWindow = maxPerWindow
+		self.maxDigestItems = maxDigestItems
+		self.groups = {}
+		self.sentTimes = collections.defaultdict(collections.deque)
+		self.lock = threading.Lock()
+		self.queue = queue.Queue()
+		self.thread = None
+		self.sent = 0
+		self.coalesced = 0
+
+	def send(self, channel, message, key=None, item=None, summary=None):
+		"""
+		Send or coalesce an alert
+
+		:param channel: alert channel
+		:param message: full alert message
+		:param key: 	template key. Alerts with the same key are grouped in the same digest.
+						None = group only identical messages. Default: None
+		:param item: short description of this alert, listed in the digest. Default: `message`
+		:param summary: digest description, eg: "users auto-restricted". Default: "similar alerts"
+		:return:
+		"""
+		if self.thread is None:
+			self.start()
+		now = time.time()
+		groupKey = (channel, key if key is not None else message)
+		with self.lock:
+			group = self.groups.get(groupKey)
+			if group is None:
+				group = alertGroup(channel, key, summary, now)
+				self.groups[groupKey] = group
+			group.count += 1
+			if not group.sent and self.__takeBudget(channel, now):
+				group.sent = True
+				group.count -= 1
+				self.sent += 1
+				self.queue.put((channel, message))
+				return
+			self.coalesced += 1
+			if group.message is None:
+				group.message = message
+			if len(group.items) < self.maxDigestItems:
+				group.items.append(item if item is not None else message)
+
+	def start(self):
+		"""
+		Start the sender thread, if it's not running yet
+
+		:return:
+		"""
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.__sendLoop, name="alertCoalescer", daemon=True)
+			self.thread.start()
+
+	def flush(self):
+		"""
+		Send the digests of all groups now, without waiting for the end of their windows
+
+		:return:
+		"""
+		self.__sendDigests(force=True)
+
+	def __takeBudget(self, channel, now):
+		times = self.sentTimes[channel]
+		while times and now - times[0] >= self.window:
+			times.popleft()
+		if len(times) >= self.maxPerWindow:
+			return False
+		times.append(now)
+		return True
+
+	def __sendDigests(self, force=False):
+		now = time.time()
+		digests = []
+		with self.lock:
+			for groupKey, group in list(self.groups.items()):
+				if not force and now - group.windowStart < self.window:
+					continue
+				del self.groups[groupKey]
+				if group.count > 0:
+					digests.append((group.channel, self.digest(group)))
+		for channel, message in digests:
+			self.queue.put((channel, message))
+
+	def digest(self, group):
+		"""
+		Return the digest message of a group
+
+		:param group: alertGroup object
+		:return: digest message
+		"""
+		if not group.sent and group.count == 1:
+			# Held back only because the channel budget was used up, it was delayed but never repeated
+			return group.message
+		if group.key is None:
+			return "{message} (repeated {count} {more}times in last {window}s)".format(
+				message=group.items[0],
+				count=group.count,
+				more="more " if group.sent else "",
+				window=self.window
+			)
+		items = ", ".join(group.items)
+		if group.count > len(group.items):
+			items += " and {} more".format(group.count - len(group.items))
+		return "{count} {more}{summary} in last {window}s: {items}".format(
+			count=group.count,
+			more="more " if group.sent else "",
+			summary=group.summary if group.summary is not None else "similar alerts",
+			window=self.window,
+			items=items
+		)
+
+	def __sendLoop(self):
+		while True:
+			try:
+				channel, message = self.queue.get(timeout=1)
+			except queue.Empty:
+				self.__sendDigests()
+				continue
+			try:
+				self.sendFunction(channel, message)
+			except Exception as e:
+				logging.error("Error while sending alert to {} ({})".format(channel, e))
+			finally:
+				self.queue.task_done()
+			self.__sendDigests()
@@ -1,13 +1,89 @@
+import atexit
 import logging
 import sys
+import threading
 
 from common.constants import bcolors
 from common import generalUtils
+from common.log import alertCoalescer, queuedWriter, rateLimiter, rotatingLog
 
 import time
 import os
 
 ENDL = "\n" if os.name == "posix" else "\r\n"
+DISCORD_CHANNELS = ("bunker", "cm", "staff", "general")
+
+# Console output is written by a background thread, see common.log.queuedWriter
+writer = queuedWriter.queuedWriter()
+
+# Files written by `logMessage`'s `of` argument, see common.log.rotatingLog
+DATA_FOLDER = ".data"
+fileLogs = {}
+fileLogsLock = threading.Lock()
+# rotatingLog options for each file name. Files without options use rotatingLog's defaults.
+fileLogsOptions = {}
+
+_timestampLock = threading.Lock()
+_timestampSecond = None
+_timestamp = None
+
+def getTimestamp():
+	"""
+	Same as `generalUtils.getTimestamp`, but it's computed at most once per second
+
+	:return: readable timestamp
+	"""
+	global _timestampSecond, _timestamp
+	now = int(time.time())
+	with _timestampLock:
+		if now != _timestampSecond:
+			_timestamp = generalUtils.getTimestamp()
+			_timestampSecond = now
+		return _timestamp
+
+def getFileLog(fileName):
+	"""
+	Return the rotating log for `fileName`, creating it if needed
+
+	:param fileName: file name, inside DATA_FOLDER
+	:return: rotatingLog object
+	"""
+	with fileLogsLock:
+		if fileName not in fileLogs:
+			fileLogs[fileName] = rotatingLog.rotatingLog(
+				os.path.join(DATA_FOLDER, fileName),
+				**fileLogsOptions.get(fileName, {})
+			)
+		return fileLogs[fileName]
+
+@atexit.register
+def flushFileLogs():
+	"""
+	Write all buffered file logs to disk
+
+	:return:
+	"""
+	with fileLogsLock:
+		logs = list(fileLogs.values())
+	for l in logs:
+		l.flush()
+
+def enableQueuedLogging(level=logging.INFO, fmt="[%(asctime)s] %(levelname)s - %(message)s"):
+	"""
+	Replace stdlib logging root handlers with a handler that writes through `writer`,
+	so `warning`, `error`, `info` and `debug` never block on stdout.
+
+	:param level: root logger level. Default: logging.INFO
+	:param fmt: log format. Default: same format as `logMessage`
+	:return:
+	"""
+	handler = queuedWriter.queuedHandler(writer)
+	handler.setFormatter(logging.Formatter(fmt, "%Y-%m-%d %H:%M:%S"))
+	root = logging.getLogger()
+	for h in list(root.handlers):
+		root.removeHandler(h)
+	root.addHandler(handler)
+	root.setLevel(level)
 
 def logMessage(message, alertType = "INFO", messageColor = bcolors.ENDC, discord = None, alertDev = False, of = None, stdout = True):
 	"""
@@ -38,25 +114,38 @@ def logMessage(message, alertType = "INFO", messageColor = bcolors.ENDC, discord
 	else:
 		typeColor = bcolors.ENDC
 
-	# Message without colors
-	finalMessage = "[{time}] {type} - {message}".format(time=generalUtils.getTimestamp(), type=alertType, message=message)
+	# Log to console
+	if stdout:
+		# Message with colors
+		finalMessageConsole = "{typeColor}[{time}] {type}{endc} - {messageColor}{message}{endc}\n".format(
+			time=getTimestamp(),
+			type=alertType,
+			message=message,
 
-	# Message with colors
-	finalMessageConsole = "{typeColor}[{time}] {type}{endc} - {messageColor}{message}{endc}".format(
-		time=generalUtils.getTimestamp(),
-		type=alertType,
-		message=message,
+			typeColor=typeColor,
+			messageColor=messageColor,
+			endc=bcolors.ENDC)
+		writer.write(finalMessageConsole)
 
-		typeColor=typeColor,
-		messageColor=messageColor,
-		endc=bcolors.ENDC)
+	# Log to file
+	if of is not None:
+		# Message without colors
+		finalMessage = "[{time}] {type} - {message}{endl}".format(
+			time=getTimestamp(),
+			type=alertType,
+			message=message,
+			endl=ENDL
+		)
+		getFileLog(of).write(finalMessage)
 
-	# Log to console
-	if stdout:
-		print(finalMessageConsole)
-		sys.stdout.flush()
+def sendDiscord(channel, message):
+	"""
+	Send a message to a discord channel through Schiavo, without coalescing
 
-def discord(channel, message, level=None):
+	:param channel: channel acronym (bunker, cm, staff or general)
+	:param message: message
+	:return:
+	"""
 	import objects.glob
 
 	if channel == "bunker":
@@ -70,19 +159,41 @@ def discord(channel, message, level=None):
 	else:
 		raise ValueError("Unsupported channel ({})".format(channel))
 
+# Discord alerts are deduplicated, rate limited per channel and sent from a background thread
+alerts = alertCoalescer.alertCoalescer(sendDiscord)
+
+def discord(channel, message, level=None, key=None, item=None, summary=None):
+	"""
+	Send a message to a discord channel, through the alert coalescer
+
+	:param channel: channel acronym (bunker, cm, staff or general)
+	:param message: message
+	:param level: if not None, log the message with stdlib logging too. Default: None
+	:param key: coalescing key, see `alertCoalescer.send`. Default: group only identical messages
+	:param item: short description of this message, listed in digests. Default: `message`
+	:param summary: digest description, eg: "users auto-restricted". Default: "similar alerts"
+	:return:
+	"""
+	if channel not in DISCORD_CHANNELS:
+		raise ValueError("Unsupported channel ({})".format(channel))
+	alerts.send(channel, message, key=key, item=item, summary=summary)
+
 	# Log with stdlib logging
 	if level is not None:
 		LEVELS_MAPPING.get(level.lower(), info)(message)
 
 
-def cm(message):
+def cm(message, key=None, item=None, summary=None):
 	"""
 	CM logging (to discord and with logging)
 
 	:param message: the message to log
+	:param key: coalescing key, see `discord`. Default: None
+	:param item: short description, listed in digests. Default: None
+	:param summary: digest description. Default: None
 	:return:
 	"""
-	return discord("cm", message, level="warning")
+	return discord("cm", message, level="warning", key=key, item=item, summary=summary)
 
 
 def warning(message):
@@ -97,8 +208,85 @@ def info(message):
 	logging.info(message)
 
 
-def debug(message):
-	logging.debug(message)
+def debug(message, *args):
+	"""
+	Log a debug message.
+	If `args` are passed, `message` is %-formatted with them only if debug logging is enabled.
+
+	:param message: message or %-format string
+	:param args: format arguments
+	:return:
+	"""
+	logging.debug(message, *args)
+
+def logSuppressed(key, count):
+	"""
+	Log a summary of suppressed rate limited messages and send it to datadog, if enabled
+
+	:param key: rate limiting key
+	:param count: number of suppressed messages
+	:return:
+	"""
+	import objects.glob
+	logging.warning("Suppressed {} similar messages: {}".format(count, key))
+	dog = getattr(objects.glob, "dog", None)
+	if dog is not None:
+		dog.increment(objects.glob.DATADOG_PREFIX + ".log.suppressed", count, tags=["key:{}".format(key[:200])])
+
+# Rate limiter used by `errorLimited`, `warningLimited` and `allowLimited`
+limiter = rateLimiter.rateLimiter(summaryFunction=logSuppressed)
+
+def allowLimited(key):
+	"""
+	Check if a rate limited message can be logged.
+	Use this instead of `errorLimited` if building the message is expensive.
+
+	:param key: rate limiting key
+	:return: 	None if the message must be suppressed,
+				otherwise the number of similar messages suppressed since the last one that was logged
+	"""
+	return limiter.allow(key)
+
+def suppressedSuffix(suppressed):
+	"""
+	Return the text appended to a rate limited message
+
+	:param suppressed: number of suppressed messages, returned by `allowLimited`
+	:return: suffix string
+	"""
+	return " (suppressed {} similar messages)".format(suppressed) if suppressed else ""
+
+def _logLimited(logFunction, template, args, key, depth=2):
+	if key is None:
+		frame = sys._getframe(depth)
+		key = "{}:{}:{}".format(frame.f_code.co_filename, frame.f_lineno, template)
+	suppressed = limiter.allow(key)
+	if suppressed is None:
+		return
+	logFunction((template.format(*args) if args else template) + suppressedSuffix(suppressed))
+
+def errorLimited(template, *args, key=None):
+	"""
+	Log an error, rate limited by call site and template.
+	`template` is formatted with `args` only if the message gets through.
+
+	:param template: message template, with `str.format` placeholders
+	:param args: format arguments
+	:param key: rate limiting key. Default: caller's file, line and template
+	:return:
+	"""
+	_logLimited(error, template, args, key)
+
+def warningLimited(template, *args, key=None):
+	"""
+	Same as `errorLimited`, but logs a warning
+
+	:param template: message template, with `str.format` placeholders
+	:param args: format arguments
+	:param key: rate limiting key. Default: caller's file, line and template
+	:return:
+	"""
+	_logLimited(warning, template, args, key)
 
 def chat(message):
 	"""
@@ -121,8 +309,15 @@ def rap(userID, message, discordChannel=None, through="FokaBot"):
 	:return:
 	"""
 	import common.ripple
-	#import objects.glob
-	#objects.glob.db.execute("INSERT INTO rap_logs (id, userid, text, datetime, through) VALUES (NULL, %s, %s, %s, %s)", [userID, message, int(time.time()), through])
+	import objects.glob
+
+	# Use the batched writer, if the application has one (see common.log.rapLogWriter)
+	rapLog = getattr(objects.glob, "rapLog", None)
+	if rapLog is not None:
+		rapLog.log(userID, message, discordChannel=discordChannel, through=through)
+		return
+
+	objects.glob.db.execute("INSERT INTO rap_logs (id, userid, text, datetime, through) VALUES (NULL, %s, %s, %s, %s)", [userID, message, int(time.time()), through])
 	username = common.ripple.userUtils.getUsername(userID)
 	if discordChannel is not None:
 		discord(discordChannel, "{} {}".format(username, message))
@@ -0,0 +1,114 @@
+import atexit
+import logging
+import queue
+import sys
+import threading
+
+
+class queuedWriter:
+	"""
+	Writes log lines to a stream from a background thread, in batches.
+	Writing a line only puts it in a queue, so a slow stdout never blocks the caller.
+	If the queue is full or the stream can't be written, lines are dropped and counted in `self.dropped`.
+	"""
+	def __init__(self, stream=None, maxQueueSize=100000, batchSize=500):
+		"""
+		Initialize a queued writer
+
+		:param stream: output stream. Default: sys.stdout (resolved on every write, so it can be replaced)
+		:param maxQueueSize: max number of lines waiting to be written. Default: 100000
+		:param batchSize: max number of lines written at once. Default: 500
+		"""
+		self.stream = stream
+		self.queue = queue.Queue(maxsize=maxQueueSize)
+		self.batchSize = batchSize
+		self.dropped = 0
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def write(self, item):
+		"""
+		Queue a line, or a (logging.Handler, logging.LogRecord) tuple that's formatted by the writer thread
+
+		:param item: line (with line terminator) or (handler, record) tuple
+		:return:
+		"""
+		if self.thread is None:
+			self.start()
+		try:
+			self.queue.put_nowait(item)
+		except queue.Full:
+			self.dropped += 1
+
+	def start(self):
+		"""
+		Start the writer thread, if it's not running yet
+
+		:return:
+		"""
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.__writeLoop, name="queuedWriter", daemon=True)
+			self.thread.start()
+			atexit.register(self.flush)
+
+	def flush(self):
+		"""
+		Wait until all queued lines have been written
+
+		:return:
+		"""
+		if self.thread is not None and self.thread.is_alive():
+			self.queue.join()
+
+	def __writeLoop(self):
+		while True:
+			items = [self.queue.get()]
+			try:
+				while len(items) < self.batchSize:
+					items.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			try:
+				lines = []
+				for item in items:
+					if isinstance(item, tuple):
+						# A bad record must not drop the rest of the batch, report it like logging.StreamHandler does
+						handler, record = item
+						try:
+							lines.append(handler.format(record) + "\n")
+						except Exception:
+							handler.handleError(record)
+					else:
+						lines.append(item)
+				if lines:
+					self.__writeLines(lines)
+			finally:
+				for _ in items:
+					self.queue.task_done()
+
+	def __writeLines(self, lines):
+		stream = self.stream if self.stream is not None else sys.stdout
+		try:
+			stream.write("".join(lines))
+			stream.flush()
+		except Exception as e:
+			self.dropped += len(lines)
+			try:
+				sys.__stderr__.write("queuedWriter: {} lines lost, write failed ({})\n".format(len(lines), e))
+			except Exception:
+				pass
+
+
+class queuedHandler(logging.Handler):
+	"""
+	stdlib logging handler that writes records through a queuedWriter.
+	Records are formatted by the writer thread.
+	"""
+	def __init__(self, writer, level=logging.NOTSET):
+		super().__init__(level)
+		self.writer = writer
+
+	def emit(self, record):
+		self.writer.write((self, record))
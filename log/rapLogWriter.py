@@ -0,0 +1,124 @@
+import threading
+import time
+
+from common.db import periodicFlusher
+from common.log import logUtils as log
+from objects import glob
+
+
+class rapLogWriter(periodicFlusher.periodicFlusher):
+	"""
+	Admin (RAP) logs writer.
+	Queues admin actions and writes them to `rap_logs` periodically, with multi-row inserts.
+	Usernames for discord messages are resolved with a single query per chunk and cached.
+	"""
+	flushDescription = "RAP logs"
+
+	def __init__(self, interval=2, chunkSize=500, usernameTTL=300, maxUsernames=10000):
+		"""
+		Initialize a RAP log writer
+
+		:param interval: seconds between flushes. Default: 2
+		:param chunkSize: max rows per query. Default: 500
+		:param usernameTTL: seconds a username stays in cache. Default: 300
+		:param maxUsernames: max cached usernames. Default: 10000
+		"""
+		super().__init__(interval)
+		self.chunkSize = chunkSize
+		self.usernameTTL = usernameTTL
+		self.maxUsernames = maxUsernames
+		self.pending = []
+		self.usernames = {}
+		self.lock = threading.Lock()
+
+	def log(self, userID, message, discordChannel=None, through="FokaBot"):
+		"""
+		Queue an admin action
+
+		:param userID: admin user ID
+		:param message: message content, without username
+		:param discordChannel: discord channel to send this message to or None to disable discord logging
+		:param through: through string. Default: FokaBot
+		:return:
+		"""
+		if discordChannel is not None and discordChannel not in log.DISCORD_CHANNELS:
+			raise ValueError("Unsupported channel ({})".format(discordChannel))
+		with self.lock:
+			self.pending.append((userID, message, int(time.time()), through, discordChannel))
+
+	def getUsernames(self, userIDs):
+		"""
+		Get the usernames of `userIDs`, from cache or with a single query
+
+		:param userIDs: iterable of user ids
+		:return: dictionary with user ids as keys and usernames as values
+		"""
+		now = time.time()
+		results = {}
+		missing = set()
+		for userID in userIDs:
+			cached = self.usernames.get(userID)
+			if cached is not None and cached[1] > now:
+				results[userID] = cached[0]
+			else:
+				missing.add(userID)
+		if missing:
+			rows = glob.db.fetchAll("SELECT user_id, username FROM phpbb_users WHERE user_id IN %s", (list(missing),))
+			if len(self.usernames) + len(rows) > self.maxUsernames:
+				self.usernames = {k: v for k, v in self.usernames.items() if v[1] > now}
+				if len(self.usernames) + len(rows) > self.maxUsernames:
+					self.usernames = {}
+			for row in rows:
+				results[row["user_id"]] = row["username"]
+				self.usernames[row["user_id"]] = (row["username"], now + self.usernameTTL)
+		return results
+
+	def invalidateUsername(self, userID):
+		"""
+		Remove `userID`'s username from cache (eg: after a username change)
+
+		:param userID: user id
+		:return:
+		"""
+		self.usernames.pop(userID, None)
+
+	def _flush(self):
+		# Write queued admin actions to db, and send every chunk to discord as soon as it's written
+		with self.lock:
+			entries = self.pending
+			self.pending = []
+		for i in range(0, len(entries), self.chunkSize):
+			chunk = entries[i:i + self.chunkSize]
+			params = []
+			for userID, message, timestamp, through, _ in chunk:
+				params.extend((userID, message, timestamp, through))
+			try:
+				glob.db.execute(
+					"INSERT INTO rap_logs (id, userid, text, datetime, through) VALUES {}".format(
+						", ".join(["(NULL, %s, %s, %s, %s)"] * len(chunk))
+					),
+					params
+				)
+			except:
+				# Queue the entries that haven't been written again, so they're retried on next flush
+				with self.lock:
+					self.pending = entries[i:] + self.pending
+				raise
+			self.__sendDiscord(chunk)
+
+	def __sendDiscord(self, entries):
+		discordEntries = [x for x in entries if x[4] is not None]
+		if not discordEntries:
+			return
+		try:
+			usernames = self.getUsernames({x[0] for x in discordEntries})
+		except Exception as e:
+			# The entries are already in db, send them without usernames rather than dropping them
+			log.error("Error while getting RAP logs usernames ({})".format(e))
+			usernames = {}
+		for userID, message, _, _, discordChannel in discordEntries:
+			# The entries are already in db, a failed message must not stop the flush
+			try:
+				log.discord(discordChannel, "{} {}".format(usernames.get(userID, userID), message))
+			except Exception as e:
+				log.error("Error while sending RAP log to discord ({})".format(e))
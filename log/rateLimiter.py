@@ -0,0 +1,111 @@
+import threading
+import time
+
+
+class tokenBucket:
+	__slots__ = ("tokens", "lastRefill", "emitted", "suppressed", "pending", "lastEmitted")
+
+	def __init__(self, tokens, now):
+		self.tokens = tokens
+		self.lastRefill = now
+		self.emitted = 0
+		self.suppressed = 0
+		self.pending = 0
+		self.lastEmitted = now
+
+
+class rateLimiter:
+	"""
+	Per-key token buckets for log lines.
+	Every key can emit `burst` lines at once, then `rate` lines per second.
+	Suppressed lines are counted, and reported either by the next line that gets through
+	or by `summaryFunction`, called every `summaryInterval` seconds.
+	"""
+	def __init__(self, rate=1.0, burst=5, summaryInterval=60, summaryFunction=None):
+		"""
+		Initialize a rate limiter
+
+		:param rate: tokens added to each bucket every second. Default: 1
+		:param burst: bucket size. Default: 5
+		:param summaryInterval: seconds between two summaries. Default: 60
+		:param summaryFunction: 	function called with (key, number of suppressed lines)
+									for the keys that have suppressed lines not reported yet. Default: None
+		"""
+		self.rate = rate
+		self.burst = burst
+		self.summaryInterval = summaryInterval
+		self.summaryFunction = summaryFunction
+		self.buckets = {}
+		self.lock = threading.Lock()
+		self.timer = None
+
+	def allow(self, key):
+		"""
+		Take a token from `key`'s bucket
+
+		:param key: rate limiting key
+		:return: 	None if the line must be suppressed,
+					otherwise the number of lines suppressed since the last one that got through
+		"""
+		now = time.monotonic()
+		with self.lock:
+			bucket = self.buckets.get(key)
+			if bucket is None:
+				bucket = tokenBucket(self.burst, now)
+				self.buckets[key] = bucket
+			bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.lastRefill) * self.rate)
+			bucket.lastRefill = now
+			if bucket.tokens < 1:
+				bucket.suppressed += 1
+				bucket.pending += 1
+				if self.timer is None and self.summaryFunction is not None:
+					self.__scheduleSummary()
+				return None
+			bucket.tokens -= 1
+			bucket.emitted += 1
+			bucket.lastEmitted = now
+			pending = bucket.pending
+			bucket.pending = 0
+			return pending
+
+	def summarize(self):
+		"""
+		Call `summaryFunction` for every key with suppressed lines not reported yet
+
+		:return:
+		"""
+		with self.lock:
+			summaries = [(k, v.pending) for k, v in self.buckets.items() if v.pending > 0]
+			for k, _ in summaries:
+				self.buckets[k].pending = 0
+			# Forget idle keys, so the buckets don't grow forever
+			now = time.monotonic()
+			for k in [k for k, v in self.buckets.items() if v.pending == 0 and now - v.lastEmitted > self.summaryInterval * 10]:
+				del self.buckets[k]
+		if self.summaryFunction is not None:
+			for key, count in summaries:
+				self.summaryFunction(key, count)
+
+	def getCounters(self):
+		"""
+		Return the counters of all keys
+
+		:return: dictionary with keys as keys and `emitted` and `suppressed` counters as values
+		"""
+		with self.lock:
+			return {k: {"emitted": v.emitted, "suppressed": v.suppressed} for k, v in self.buckets.items()}
+
+	def __scheduleSummary(self):
+		self.timer = threading.Timer(self.summaryInterval, self.__summaryLoop)
+		self.timer.daemon = True
+		self.timer.start()
+
+	def __summaryLoop(self):
+		try:
+			self.summarize()
+		finally:
+			with self.lock:
+				if any(v.pending > 0 for v in self.buckets.values()):
+					self.__scheduleSummary()
+				else:
+					self.timer = None
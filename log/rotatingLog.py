@@ -0,0 +1,287 @@
+import bisect
+import glob as globModule
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+from common.files import fileBuffer
+
+COMPRESSED_EXTENSIONS = {
+	"gzip": ".gz",
+	"zstd": ".zst"
+}
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class rotatingLog:
+	"""
+	A buffered log file split in segments.
+	A new segment is started when the current one is bigger than `maxSize` bytes or older than `maxAge` seconds.
+	Closed segments can be compressed in a background thread.
+	Segments that were not compressed by previous runs are compressed when the first segment is opened.
+
+	Every segment has a sidecar index (`<segment>.idx`) with a `timestamp offset` line every `indexInterval` seconds,
+	where offset is the uncompressed byte offset of the first line written at or after that timestamp,
+	so `read` can jump to a time range without scanning whole segments.
+
+	Segments are named `<name>.<YYYYmmdd-HHMMSS><extension>`, eg: `chatlog_public.20261019-120000.txt`.
+	"""
+	def __init__(self, path, maxSize=64*1024*1024, maxAge=86400, compression=None, indexInterval=60, bufferLength=4096):
+		"""
+		Initialize a rotating log
+
+		:param path: log path, eg: `.data/chatlog_public.txt`
+		:param maxSize: max segment size, in bytes. None = no size limit. Default: 64 MiB
+		:param maxAge: max segment age, in seconds. None = no age limit. Default: 1 day
+		:param compression: "gzip", "zstd" or None. Closed segments are compressed with this algorithm. Default: None
+		:param indexInterval: seconds between two index entries. Default: 60
+		:param bufferLength: length of the in-memory buffer before writing to disk. Default: 4096
+		"""
+		if compression not in (None, "gzip", "zstd"):
+			raise ValueError("Unsupported compression ({})".format(compression))
+		if compression == "zstd" and zstandard is None:
+			raise ValueError("zstd compression requires the zstandard package")
+		self.path = path
+		self.name, self.extension = os.path.splitext(path)
+		self.maxSize = maxSize
+		self.maxAge = maxAge
+		self.compression = compression
+		self.indexInterval = indexInterval
+		self.bufferLength = bufferLength
+		self.lock = threading.Lock()
+		self.buffer = None
+		self.segmentStart = 0
+		self.segmentSize = 0
+		self.index = []
+		self.indexFlushed = 0
+		self.lastIndexTime = None
+
+	def segmentPath(self, startTime):
+		"""
+		Return the path of the segment started at `startTime`
+
+		:param startTime: segment start UNIX time
+		:return: segment path
+		"""
+		return "{}.{}{}".format(self.name, time.strftime(SEGMENT_TIME_FORMAT, time.localtime(startTime)), self.extension)
+
+	def write(self, line):
+		"""
+		Append a line to the current segment, and start a new segment if needed
+
+		:param line: line, with line terminator
+		:return:
+		"""
+		now = time.time()
+		with self.lock:
+			if self.buffer is None or self.__shouldRotate(now):
+				self.__rotate(now)
+			if self.lastIndexTime is None or now - self.lastIndexTime >= self.indexInterval:
+				self.index.append((int(now), self.segmentSize))
+				self.lastIndexTime = now
+			self.buffer.write(line)
+			self.segmentSize += len(line.encode("utf-8"))
+
+	def flush(self):
+		"""
+		Write buffered lines and new index entries to disk
+
+		:return:
+		"""
+		with self.lock:
+			self.__flush()
+
+	def close(self):
+		"""
+		Flush and close the current segment
+
+		:return:
+		"""
+		with self.lock:
+			self.__close()
+
+	def __shouldRotate(self, now):
+		if self.maxSize is not None and self.segmentSize >= self.maxSize:
+			return True
+		if self.maxAge is not None and now - self.segmentStart >= self.maxAge:
+			return True
+		return False
+
+	def __rotate(self, now):
+		previous = self.buffer
+		self.__close()
+		os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+		# Segment names have 1 second resolution, make sure a rotated segment is never reopened
+		self.segmentStart = int(now) if previous is None else max(int(now), self.segmentStart + 1)
+		segment = self.segmentPath(self.segmentStart)
+		# Index offsets are utf-8 byte offsets, the segment must be utf-8 regardless of the locale
+		self.buffer = fileBuffer.buffer(segment, maxLength=self.bufferLength, encoding="utf-8")
+		self.segmentSize = os.path.getsize(segment) if os.path.exists(segment) else 0
+		self.index = []
+		self.indexFlushed = 0
+		self.lastIndexTime = None
+		if previous is None and self.compression is not None:
+			# Segments left by previous runs (open at exit, crashed or interrupted while compressing)
+			threading.Thread(target=self.__compressLeftovers, args=(segment,), daemon=True).start()
+
+	def __compressLeftovers(self, current):
+		for path in globModule.glob(globModule.escape(self.name) + ".*" + globModule.escape(self.extension) + "*"):
+			try:
+				if path.endswith(".tmp"):
+					os.remove(path)
+				elif path.endswith(self.extension) and path != current:
+					if os.path.exists(path + COMPRESSED_EXTENSIONS[self.compression]):
+						# Compression finished, but the uncompressed segment was not deleted
+						os.remove(path)
+					else:
+						compressSegment(path, self.compression)
+			except Exception as e:
+				logging.error("Error while compressing log segment {} ({})".format(path, e))
+
+	def __flush(self):
+		if self.buffer is None:
+			return
+		self.buffer.flush()
+		if self.indexFlushed < len(self.index):
+			with open(self.buffer.fileName + ".idx", "a") as f:
+				f.write("".join("{} {}\n".format(t, o) for t, o in self.index[self.indexFlushed:]))
+			self.indexFlushed = len(self.index)
+
+	def __close(self):
+		if self.buffer is None:
+			return
+		self.__flush()
+		self.buffer.close()
+		segment = self.buffer.fileName
+		self.buffer = None
+		if self.compression is not None:
+			threading.Thread(target=compressSegment, args=(segment, self.compression), daemon=True).start()
+
+	def segments(self):
+		"""
+		Return all the segments of this log, sorted by start time
+
+		:return: list of (start UNIX time, segment path) tuples
+		"""
+		results = {}
+		prefix = self.name + "."
+		for path in globModule.glob(globModule.escape(self.name) + ".*" + globModule.escape(self.extension) + "*"):
+			if path.endswith(".idx") or path.endswith(".tmp"):
+				continue
+			stamp = path[len(prefix):].split(".")[0]
+			try:
+				startTime = int(time.mktime(time.strptime(stamp, SEGMENT_TIME_FORMAT)))
+			except ValueError:
+				continue
+			# Prefer the compressed segment if compression has already finished
+			if startTime not in results or results[startTime].endswith(self.extension):
+				results[startTime] = path
+		return sorted(results.items())
+
+	def read(self, start, end=None):
+		"""
+		Yield the lines logged between `start` and `end`.
+		Lines are selected with index granularity, so up to `indexInterval` seconds
+		of extra lines may be returned at both ends of the range.
+
+		:param start: start UNIX time
+		:param end: end UNIX time. None = until the end of the log. Default: None
+		:return: generator of lines (str)
+		"""
+		self.flush()
+		segments = self.segments()
+		for i, (_, path) in enumerate(segments):
+			# Segment names are never earlier than the first line in the segment
+			segmentEnd = segments[i + 1][0] if i + 1 < len(segments) else None
+			if segmentEnd is not None and segmentEnd < start:
+				continue
+			index = readIndex(segmentIndexPath(path))
+			if end is not None and index and index[0][0] > end:
+				break
+			times = [t for t, _ in index]
+			pos = bisect.bisect_right(times, start) - 1
+			startOffset = index[pos][1] if pos >= 0 else 0
+			endOffset = None
+			if end is not None:
+				pos = bisect.bisect_right(times, end)
+				if pos < len(index):
+					endOffset = index[pos][1]
+			with openSegment(path) as f:
+				f.seek(startOffset)
+				offset = startOffset
+				for line in f:
+					if endOffset is not None and offset >= endOffset:
+						break
+					offset += len(line)
+					yield line.decode("utf-8")
+
+
+def segmentIndexPath(path):
+	"""
+	Return the index path of a (possibly compressed) segment
+
+	:param path: segment path
+	:return: index path
+	"""
+	for extension in COMPRESSED_EXTENSIONS.values():
+		if path.endswith(extension):
+			path = path[:-len(extension)]
+			break
+	return path + ".idx"
+
+def readIndex(path):
+	"""
+	Read a segment index
+
+	:param path: index path
+	:return: list of (UNIX time, byte offset) tuples
+	"""
+	if not os.path.exists(path):
+		return []
+	with open(path, "r") as f:
+		return [tuple(int(x) for x in line.split()) for line in f if line.strip()]
+
+def openSegment(path):
+	"""
+	Open a (possibly compressed) segment for reading, as a binary file object
+
+	:param path: segment path
+	:return: file object
+	"""
+	if path.endswith(COMPRESSED_EXTENSIONS["gzip"]):
+		return gzip.open(path, "rb")
+	if path.endswith(COMPRESSED_EXTENSIONS["zstd"]):
+		if zstandard is None:
+			raise ValueError("zstd segments require the zstandard package")
+		return zstandard.open(path, "rb")
+	return open(path, "rb")
+
+def compressSegment(path, compression):
+	"""
+	Compress a closed segment and delete the uncompressed one.
+	The compressed file is written to a temporary file first, so readers never see a partial segment.
+
+	:param path: segment path
+	:param compression: "gzip" or "zstd"
+	:return: compressed segment path
+	"""
+	destination = path + COMPRESSED_EXTENSIONS[compression]
+	temp = destination + ".tmp"
+	with open(path, "rb") as src:
+		if compression == "gzip":
+			with gzip.open(temp, "wb") as dst:
+				shutil.copyfileobj(src, dst, 1024 * 1024)
+		else:
+			with open(temp, "wb") as dst:
+				zstandard.ZstdCompressor().copy_stream(src, dst)
+	os.replace(temp, destination)
+	os.remove(path)
+	return destination
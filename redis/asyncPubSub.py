@@ -0,0 +1,186 @@
+import asyncio
+import inspect
+import sys
+import traceback
+
+import redis.exceptions
+
+from common.log import logUtils as log
+from common.redis import generalPubSubHandler, pubSubMetrics
+
+
+class asyncListener:
+	def __init__(self, r, handlers=None, patternHandlers=None, minBackoff=0.5, maxBackoff=30):
+		"""
+		Initialize an asyncio redis pubSub listener.
+		Same as `common.redis.pubSub.listener`, but it runs on the application's event loop
+		(tornado's IOLoop runs on asyncio) rather than in its own thread.
+		Handlers can be coroutine functions, or `generalPubSubHandler`s with a coroutine `handle` method.
+		Regular functions and handlers are run in the event loop's default executor, so they don't block the loop.
+
+		:param r: `redis.asyncio.Redis` instance
+		:param handlers: dictionary with channel names as keys and handlers as values,
+						same as `common.redis.pubSub.listener`. Default: no channels
+		:param patternHandlers: dictionary with channel patterns (eg: `peppy:*`) as keys and handlers as values.
+								Default: no patterns
+		:param minBackoff: seconds to wait before the first reconnection attempt. Default: 0.5
+		:param maxBackoff: max seconds to wait between reconnection attempts. Default: 30
+		"""
+		self.redis = r
+		self.handlers = dict(handlers) if handlers is not None else {}
+		self.patternHandlers = dict(patternHandlers) if patternHandlers is not None else {}
+		for handler in list(self.handlers.values()) + list(self.patternHandlers.values()):
+			generalPubSubHandler.checkHandler(handler)
+		self.minBackoff = minBackoff
+		self.maxBackoff = maxBackoff
+		self.pubSub = None
+		self.task = None
+		self.running = False
+		# Set when there's at least one channel or pattern to listen on
+		self.subscribed = asyncio.Event()
+		if self.handlers or self.patternHandlers:
+			self.subscribed.set()
+
+	def start(self):
+		"""
+		Start listening on the running event loop
+
+		:return: asyncio task
+		"""
+		self.running = True
+		self.task = asyncio.ensure_future(self.run())
+		return self.task
+
+	async def stop(self):
+		"""
+		Stop listening and close the connection
+
+		:return:
+		"""
+		self.running = False
+		if self.task is not None:
+			self.task.cancel()
+		await self.__close()
+
+	async def subscribe(self, channel, handler):
+		"""
+		Start listening on `channel`
+
+		:param channel: channel name
+		:param handler: channel handler
+		:return:
+		"""
+		generalPubSubHandler.checkHandler(handler)
+		self.handlers[channel] = handler
+		if self.pubSub is not None:
+			await self.pubSub.subscribe(channel)
+		self.subscribed.set()
+
+	async def unsubscribe(self, channel):
+		"""
+		Stop listening on `channel`
+
+		:param channel: channel name
+		:return:
+		"""
+		self.handlers.pop(channel, None)
+		if self.pubSub is not None:
+			await self.pubSub.unsubscribe(channel)
+
+	async def psubscribe(self, pattern, handler):
+		"""
+		Start listening on all channels that match `pattern`
+
+		:param pattern: channel pattern
+		:param handler: handler for the messages of all matching channels
+		:return:
+		"""
+		generalPubSubHandler.checkHandler(handler)
+		self.patternHandlers[pattern] = handler
+		if self.pubSub is not None:
+			await self.pubSub.psubscribe(pattern)
+		self.subscribed.set()
+
+	async def punsubscribe(self, pattern):
+		"""
+		Stop listening on the channels that match `pattern`
+
+		:param pattern: channel pattern
+		:return:
+		"""
+		self.patternHandlers.pop(pattern, None)
+		if self.pubSub is not None:
+			await self.pubSub.punsubscribe(pattern)
+
+	async def run(self):
+		"""
+		Listen for data on incoming channels and process it.
+		Reconnects with exponential backoff if the connection is lost.
+		Runs until `stop` is called.
+
+		:return:
+		"""
+		backoff = self.minBackoff
+		while self.running:
+			# A pubsub that's not subscribed to anything has no connection to read from
+			await self.subscribed.wait()
+			try:
+				self.pubSub = self.redis.pubsub()
+				if self.handlers:
+					await self.pubSub.subscribe(*self.handlers)
+				if self.patternHandlers:
+					await self.pubSub.psubscribe(*self.patternHandlers)
+				log.debug("Subscribed to redis pubsub channels: {} and patterns: {}".format(
+					list(self.handlers), list(self.patternHandlers)
+				))
+				backoff = self.minBackoff
+				while self.running:
+					item = await self.pubSub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+					if item is not None:
+						await self.processItem(item)
+			except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, OSError) as e:
+				log.error("Redis pubsub connection error ({}). Reconnecting in {} seconds.".format(e, backoff))
+				await self.__close()
+				await asyncio.sleep(backoff)
+				backoff = min(backoff * 2, self.maxBackoff)
+		await self.__close()
+
+	async def processItem(self, item):
+		"""
+		Processes a pubSub item by calling (and awaiting, if needed) channel's or pattern's handler
+
+		:param item: incoming data
+		:return:
+		"""
+		if item["type"] == "message":
+			channel = item["channel"].decode("utf-8") if isinstance(item["channel"], bytes) else item["channel"]
+			handler = self.handlers.get(channel)
+		elif item["type"] == "pmessage":
+			channel = item["pattern"].decode("utf-8") if isinstance(item["pattern"], bytes) else item["pattern"]
+			handler = self.patternHandlers.get(channel)
+		else:
+			return
+		if handler is None:
+			return
+		if pubSubMetrics.shouldLog():
+			log.info("Redis pubsub: {} <- {} ".format(channel, item["data"]))
+		try:
+			function = handler.handle if isinstance(handler, generalPubSubHandler.generalPubSubHandler) else handler
+			if inspect.iscoroutinefunction(function):
+				result = function(item["data"])
+			else:
+				# Don't block the event loop with synchronous handlers
+				result = await asyncio.get_running_loop().run_in_executor(None, function, item["data"])
+			if inspect.isawaitable(result):
+				await result
+		except Exception:
+			log.error("Unhandled exception!\n```\n{}\n{}```".format(sys.exc_info(), traceback.format_exc()))
+
+	async def __close(self):
+		if self.pubSub is None:
+			return
+		try:
+			await self.pubSub.close()
+		except Exception:
+			pass
+		self.pubSub = None
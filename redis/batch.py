@@ -0,0 +1,86 @@
+from objects import glob
+
+
+class batch:
+	"""
+	Redis commands batch.
+	Queues redis commands in a pipeline and sends them in a single round trip,
+	either when the batch is closed or when `maxCommands` commands have been queued.
+
+	Use it as a context manager:
+	```
+	with batch.batch() as b:
+		b.zrem("ripple:leaderboard:std", "1000")
+		b.publish("peppy:ban", 1000)
+	```
+	"""
+	def __init__(self, r=None, transaction=False, maxCommands=1000):
+		"""
+		Initialize a redis commands batch
+
+		:param r: redis instance. Optional. Default: glob.redis
+		:param transaction: 	if True, wrap every flush in MULTI/EXEC.
+								Note that auto flushed chunks are separate transactions. Default: False
+		:param maxCommands: number of queued commands that triggers an automatic flush. 0 = never. Default: 1000
+		"""
+		self.redis = r if r is not None else glob.redis
+		self.transaction = transaction
+		self.maxCommands = maxCommands
+		self.pipe = self.redis.pipeline(transaction=transaction)
+		self.queued = 0
+		self.results = []
+
+	def __getattr__(self, name):
+		"""
+		Return a function that queues the redis command `name` in this batch
+
+		:param name: redis command name (eg: `zrem`)
+		:return:
+		"""
+		if name == "pipe":
+			raise AttributeError(name)
+		command = getattr(self.pipe, name)
+		if not callable(command):
+			return command
+
+		def queue(*args, **kwargs):
+			command(*args, **kwargs)
+			self.queued += 1
+			if 0 < self.maxCommands <= self.queued:
+				self.flush()
+			return self
+		return queue
+
+	def flush(self):
+		"""
+		Send all queued commands to redis
+
+		:return: list with the results of the commands sent in this flush
+		"""
+		if self.queued == 0:
+			return []
+		try:
+			results = self.pipe.execute()
+		finally:
+			self.queued = 0
+		self.results.extend(results)
+		return results
+
+	def reset(self):
+		"""
+		Discard all queued commands
+
+		:return:
+		"""
+		self.pipe.reset()
+		self.queued = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.flush()
+		else:
+			self.reset()
+		return False
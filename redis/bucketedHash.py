@@ -0,0 +1,122 @@
+import time
+import zlib
+
+from objects import glob
+
+
+class bucketedHash:
+	"""
+	A redis key/value store that spreads its fields over a fixed number of small hashes (buckets).
+	Small hashes are stored by redis in the compact listpack encoding, so this uses much less memory
+	than one redis key per entry, as long as each bucket stays below `hash-max-listpack-entries`.
+	Every field can have its own expiration time. Expired fields are ignored when read
+	and deleted by `compact`.
+	"""
+	def __init__(self, prefix, buckets=1024):
+		"""
+		Initialize a bucketed hash
+
+		:param prefix: buckets keys prefix. Bucket keys are `{prefix}:{bucket}`
+		:param buckets: number of buckets. Default: 1024
+		"""
+		self.prefix = prefix
+		self.buckets = buckets
+
+	def bucketKey(self, bucketOf):
+		"""
+		Return the key of the bucket that holds `bucketOf`'s fields.
+		Fields with the same `bucketOf` are always in the same bucket.
+
+		:param bucketOf: int or string
+		:return: redis key
+		"""
+		if isinstance(bucketOf, int):
+			bucket = bucketOf % self.buckets
+		else:
+			bucket = zlib.crc32(str(bucketOf).encode("utf-8")) % self.buckets
+		return "{}:{}".format(self.prefix, bucket)
+
+	@staticmethod
+	def _encode(value, ttl):
+		return "{}:{}".format(int(time.time()) + ttl if ttl else 0, value)
+
+	@staticmethod
+	def _decode(value):
+		if value is None:
+			return None
+		if isinstance(value, bytes):
+			value = value.decode("utf-8")
+		expiresAt, value = value.split(":", 1)
+		expiresAt = int(expiresAt)
+		if expiresAt != 0 and expiresAt < time.time():
+			return None
+		return value
+
+	def get(self, bucketOf, field):
+		"""
+		Get a field's value
+
+		:param bucketOf: value used to choose the bucket
+		:param field: field name
+		:return: value as string, or None if the field doesn't exist or is expired
+		"""
+		return self._decode(glob.redis.hget(self.bucketKey(bucketOf), field))
+
+	def set(self, bucketOf, field, value, ttl=0, b=None):
+		"""
+		Set a field's value
+
+		:param bucketOf: value used to choose the bucket
+		:param field: field name
+		:param value: new value
+		:param ttl: seconds after which the field expires. 0 = never. Default: 0
+		:param b: `common.redis.batch.batch` object to queue the command in. If None, it's sent right away. Default: None
+		:return:
+		"""
+		(b if b is not None else glob.redis).hset(self.bucketKey(bucketOf), field, self._encode(value, ttl))
+
+	def delete(self, bucketOf, field, b=None):
+		"""
+		Delete a field
+
+		:param bucketOf: value used to choose the bucket
+		:param field: field name
+		:param b: `common.redis.batch.batch` object to queue the command in. If None, it's sent right away. Default: None
+		:return:
+		"""
+		(b if b is not None else glob.redis).hdel(self.bucketKey(bucketOf), field)
+
+	def anyWithPrefix(self, bucketOf, prefix):
+		"""
+		Check if there's at least one non expired field whose name starts with `prefix`
+
+		:param bucketOf: value used to choose the bucket
+		:param prefix: field name prefix
+		:return: True if there's such a field, otherwise False
+		"""
+		for _, value in glob.redis.hscan_iter(self.bucketKey(bucketOf), match="{}*".format(prefix)):
+			if self._decode(value) is not None:
+				return True
+		return False
+
+	def compact(self, chunkSize=100):
+		"""
+		Delete all expired fields
+
+		:param chunkSize: number of buckets read per redis round trip. Default: 100
+		:return: number of deleted fields
+		"""
+		deleted = 0
+		for start in range(0, self.buckets, chunkSize):
+			keys = ["{}:{}".format(self.prefix, x) for x in range(start, min(start + chunkSize, self.buckets))]
+			pipe = glob.redis.pipeline(transaction=False)
+			for key in keys:
+				pipe.hgetall(key)
+			buckets = pipe.execute()
+			for key, bucket in zip(keys, buckets):
+				expired = [k for k, v in bucket.items() if self._decode(v) is None]
+				if expired:
+					pipe.hdel(key, *expired)
+					deleted += len(expired)
+			pipe.execute()
+		return deleted
@@ -0,0 +1,219 @@
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import redis.exceptions
+
+from common.log import logUtils as log
+from common.redis import batch, generalPubSubHandler
+from objects import glob
+
+# If True, `publish` and `publishMany` add every message to a redis stream too (`{channel}:stream`),
+# so it can be processed by `consumer`s without being lost if no process is listening.
+# Off by default, messages are only sent through PUBLISH.
+streamsEnabled = False
+
+# Approximate max number of messages kept in each stream
+MAX_STREAM_LENGTH = 100000
+
+
+def streamName(channel):
+	"""
+	Return the name of the redis stream that mirrors `channel`
+
+	:param channel: pubsub channel name
+	:return: stream name
+	"""
+	return "{}:stream".format(channel)
+
+def publish(channel, data, b=None):
+	"""
+	Send a message through a pubsub channel and, if streams are enabled, add it to its stream
+
+	:param channel: channel name
+	:param data: message, str/bytes/int
+	:param b: `common.redis.batch.batch` object to queue the commands in. If None, they're sent right away. Default: None
+	:return:
+	"""
+	if b is None and not streamsEnabled:
+		glob.redis.publish(channel, data)
+		return
+	r = b if b is not None else glob.redis.pipeline(transaction=False)
+	r.publish(channel, data)
+	if streamsEnabled:
+		r.xadd(streamName(channel), {"data": data}, maxlen=MAX_STREAM_LENGTH, approximate=True)
+	if b is None:
+		r.execute()
+
+def publishMany(channel, messages, b=None):
+	"""
+	Send many messages through a pubsub channel (and its stream) in a single round trip
+
+	:param channel: channel name
+	:param messages: list of messages
+	:param b: `common.redis.batch.batch` object to queue the commands in. If None, they're sent right away. Default: None
+	:return:
+	"""
+	if b is None:
+		with batch.batch(maxCommands=0) as b:
+			return publishMany(channel, messages, b)
+	for data in messages:
+		publish(channel, data, b)
+
+
+class consumer(threading.Thread):
+	def __init__(self, r, handlers, group, consumerName=None, count=100, block=5000, claimIdle=60000, maxDeliveries=5):
+		"""
+		Initialize a redis streams consumer.
+		Consumers with the same `group` share the messages of their streams,
+		every message is processed by only one of them and acknowledged once its handler returns.
+		Messages whose handler raised an exception, or whose consumer died, are claimed
+		by another consumer after `claimIdle` milliseconds.
+
+		:param r: redis instance (usually glob.redis)
+		:param handlers: 	dictionary with channel names as keys and handlers as values,
+							same as `common.redis.pubSub.listener`.
+							Messages are read from each channel's stream (see `streamName`).
+		:param group: consumer group name
+		:param consumerName: name of this consumer, unique in the group. Default: hostname:pid
+		:param count: max number of messages read at once. Default: 100
+		:param block: max milliseconds to wait for new messages. Default: 5000
+		:param claimIdle: milliseconds after which a pending message is claimed by this consumer. Default: 60000
+		:param maxDeliveries: number of failed deliveries after which a message is dropped. Default: 5
+		"""
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.redis = r
+		for handler in handlers.values():
+			generalPubSubHandler.checkHandler(handler)
+		self.handlers = {streamName(k): v for k, v in handlers.items()}
+		self.group = group
+		self.consumerName = consumerName if consumerName is not None else "{}:{}".format(socket.gethostname(), os.getpid())
+		self.count = count
+		self.block = block
+		self.claimIdle = claimIdle
+		self.maxDeliveries = maxDeliveries
+		self.running = False
+		self.lastClaim = 0
+		self.createGroups()
+		log.debug("Consuming redis streams {} in group {}".format(list(self.handlers), self.group))
+
+	def createGroups(self, startID="$"):
+		"""
+		Create the consumer group (and the stream) of every stream, if they don't exist
+
+		:param startID: id of the last message already processed by new groups. Default: "$" (only new messages)
+		:return:
+		"""
+		for stream in self.handlers:
+			try:
+				self.redis.xgroup_create(stream, self.group, id=startID, mkstream=True)
+			except redis.exceptions.ResponseError as e:
+				# The group already exists
+				if "BUSYGROUP" not in str(e):
+					raise
+
+	def processMessage(self, stream, messageID, fields):
+		"""
+		Call `stream`'s handler and acknowledge the message if it doesn't raise any exception
+
+		:param stream: stream name
+		:param messageID: message id
+		:param fields: message fields
+		:return:
+		"""
+		if isinstance(stream, bytes):
+			stream = stream.decode("utf-8")
+		handler = self.handlers.get(stream)
+		if handler is None:
+			return
+		data = fields.get(b"data", fields.get("data"))
+		try:
+			if isinstance(handler, generalPubSubHandler.generalPubSubHandler):
+				handler.handle(data)
+			else:
+				handler(data)
+		except:
+			log.error("Unhandled exception while processing message {} from {}!\n```\n{}\n{}```".format(
+				messageID, stream, sys.exc_info(), traceback.format_exc()
+			))
+			return
+		self.redis.xack(stream, self.group, messageID)
+
+	def claimPending(self):
+		"""
+		Process the messages that have not been acknowledged by any consumer for `self.claimIdle` milliseconds.
+		Messages delivered more than `self.maxDeliveries` times are dropped.
+
+		:return:
+		"""
+		for stream in self.handlers:
+			pending = self.redis.xpending_range(stream, self.group, "-", "+", self.count, idle=self.claimIdle)
+			if not pending:
+				continue
+			dropped = [x["message_id"] for x in pending if x["times_delivered"] >= self.maxDeliveries]
+			if dropped:
+				log.error("Dropping {} messages from {} after {} failed deliveries".format(
+					len(dropped), stream, self.maxDeliveries
+				))
+				self.redis.xack(stream, self.group, *dropped)
+			claim = [x["message_id"] for x in pending if x["times_delivered"] < self.maxDeliveries]
+			if claim:
+				for messageID, fields in self.redis.xclaim(stream, self.group, self.consumerName, self.claimIdle, claim):
+					if fields is not None:
+						self.processMessage(stream, messageID, fields)
+
+	def run(self):
+		"""
+		Read and process messages until `stop` is called
+
+		:return:
+		"""
+		self.running = True
+		while self.running:
+			try:
+				if time.time() - self.lastClaim >= self.claimIdle / 1000:
+					self.lastClaim = time.time()
+					self.claimPending()
+				result = self.redis.xreadgroup(
+					self.group,
+					self.consumerName,
+					{x: ">" for x in self.handlers},
+					count=self.count,
+					block=self.block
+				)
+				for stream, messages in result or ():
+					for messageID, fields in messages:
+						self.processMessage(stream, messageID, fields)
+			except redis.exceptions.ConnectionError as e:
+				log.error("Redis streams consumer connection error ({}). Retrying in 1 second.".format(e))
+				time.sleep(1)
+			except redis.exceptions.ResponseError as e:
+				if "NOGROUP" not in str(e):
+					log.error("Redis streams consumer error ({}). Retrying in 1 second.".format(e))
+					time.sleep(1)
+					continue
+				# The stream or the group was deleted (eg: FLUSHDB), create them again
+				# and process the messages added to a new stream in the meantime
+				log.warning("Redis streams consumer group {} not found. Creating it again.".format(self.group))
+				try:
+					self.createGroups(startID="0")
+				except Exception as e:
+					log.error("Could not create redis streams consumer group {} ({}). Retrying in 1 second.".format(self.group, e))
+					time.sleep(1)
+			except Exception:
+				log.error("Unhandled exception in redis streams consumer! Retrying in 1 second.\n```\n{}\n{}```".format(
+					sys.exc_info(), traceback.format_exc()
+				))
+				time.sleep(1)
+
+	def stop(self):
+		"""
+		Stop reading messages. Messages already read are processed.
+
+		:return:
+		"""
+		self.running = False
@@ -1,5 +1,17 @@
 import json
 
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+from common.redis import pubSubMetrics
+
 def shape(d):
 	"""
 	Returns a shape of a dictionary.
@@ -13,6 +25,54 @@ def shape(d):
 	else:
 		return None
 
+def compileShape(structure):
+	"""
+	Returns a function that checks if a value has the same shape as `structure`.
+	Same as `shape(value) == shape(structure)`, but `structure`'s shape is computed only once.
+
+	:param structure: reference structure
+	:return: function that accepts a value and returns True if it has the same shape as `structure`
+	"""
+	if not isinstance(structure, dict):
+		return lambda d: not isinstance(d, dict)
+	keys = frozenset(structure)
+	children = {k: compileShape(v) for k, v in structure.items() if isinstance(v, dict)}
+	leaves = tuple(k for k in structure if k not in children)
+
+	def validate(d):
+		if not isinstance(d, dict) or d.keys() != keys:
+			return False
+		for k in leaves:
+			if isinstance(d[k], dict):
+				return False
+		for k, child in children.items():
+			if not child(d[k]):
+				return False
+		return True
+	return validate
+
+def loadsJson(data):
+	"""
+	Parse json from bytes, with orjson if it's installed
+
+	:param data: json as bytes or str
+	:return: parsed data
+	"""
+	if orjson is not None:
+		return orjson.loads(data)
+	return json.loads(data)
+
+def checkHandler(handler):
+	"""
+	Call `handler.checkType` if `handler` is a `generalPubSubHandler`.
+	Used by listeners when handlers are registered, so misconfigured handlers fail before receiving any message.
+
+	:param handler: handler or function
+	:return:
+	"""
+	if isinstance(handler, generalPubSubHandler):
+		handler.checkType()
+
 class wrongStructureError(Exception):
 	pass
 
@@ -21,6 +81,30 @@ class generalPubSubHandler:
 		self.structure = {}
 		self.type = "json"
 		self.strict = True
+		self._compiledStructure = None
+		self._validator = None
+
+	def checkType(self):
+		"""
+		Make sure the parser of `self.type` is installed
+
+		:return:
+		"""
+		if self.type == "msgpack" and msgpack is None:
+			raise ValueError("msgpack pubsub data requires the msgpack package")
+
+	def validate(self, data):
+		"""
+		Check if `data` has the same shape as `self.structure`.
+		`self.structure` is compiled once, and recompiled only if it's replaced.
+
+		:param data: parsed data
+		:return: True if the shapes match, otherwise False
+		"""
+		if getattr(self, "_compiledStructure", None) is not self.structure:
+			self._validator = compileShape(self.structure)
+			self._compiledStructure = self.structure
+		return self._validator(data)
 
 	def parseData(self, data):
 		"""
@@ -33,10 +117,21 @@ class generalPubSubHandler:
 			# Parse json
 			if type(data) == int:
 				return None
-			data = json.loads(data.decode("utf-8"))
-			if shape(data) != shape(self.structure) and self.strict:
+			data = loadsJson(data)
+			pubSubMetrics.extractTimestamp(data)
+			if self.strict and not self.validate(data):
+				raise wrongStructureError()
+		elif self.type == "msgpack":
+			# Parse msgpack
+			if type(data) == int:
+				return None
+			if msgpack is None:
+				self.checkType()
+			data = msgpack.unpackb(data, raw=False)
+			pubSubMetrics.extractTimestamp(data)
+			if self.strict and not self.validate(data):
 				raise wrongStructureError()
 		elif self.type == "int":
 			# Parse int
 			data = int(data.decode("utf-8"))
-		return data
\ No newline at end of file
+		return data
@@ -0,0 +1,53 @@
+from objects import glob
+
+
+def keysUsage(pattern, maxKeys=100000, chunkSize=500):
+	"""
+	Measure the memory used by the redis keys that match `pattern`
+
+	:param pattern: redis keys pattern (eg: `ripple:userid_cache:*`)
+	:param maxKeys: max number of keys to measure. Default: 100000
+	:param chunkSize: number of keys measured per redis round trip. Default: 500
+	:return: dictionary with `keys` (number of keys), `bytes` (total memory usage, in bytes),
+			`sampled` (True if there were more than `maxKeys` keys) and `encodings` (number of keys per encoding)
+	"""
+	report = {"keys": 0, "bytes": 0, "sampled": False, "encodings": {}}
+	keys = []
+
+	def measure():
+		pipe = glob.redis.pipeline(transaction=False)
+		for key in keys:
+			pipe.memory_usage(key)
+			pipe.object("encoding", key)
+		results = pipe.execute()
+		for usage, encoding in zip(results[::2], results[1::2]):
+			if usage is None:
+				# Deleted in the meantime
+				continue
+			if isinstance(encoding, bytes):
+				encoding = encoding.decode("utf-8")
+			report["keys"] += 1
+			report["bytes"] += usage
+			report["encodings"][encoding] = report["encodings"].get(encoding, 0) + 1
+		keys.clear()
+
+	for n, key in enumerate(glob.redis.scan_iter(match=pattern, count=chunkSize)):
+		if n >= maxKeys:
+			report["sampled"] = True
+			break
+		keys.append(key)
+		if len(keys) >= chunkSize:
+			measure()
+	if keys:
+		measure()
+	return report
+
+def report(patterns, maxKeys=100000):
+	"""
+	Measure the memory used by some groups of redis keys
+
+	:param patterns: dictionary with group names as keys and redis key patterns as values
+	:param maxKeys: max number of keys to measure for each group. Default: 100000
+	:return: dictionary with group names as keys and `keysUsage` results as values
+	"""
+	return {name: keysUsage(pattern, maxKeys) for name, pattern in patterns.items()}
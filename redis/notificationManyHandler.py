@@ -0,0 +1,61 @@
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	Handler for `peppy:notification_many`, published by `common.ripple.bancho.notifyMany` and `broadcast`.
+	Pass a `notifyFunction` (or override `notify`) to send the notification to a token,
+	and override `filterTokens` to support more filters.
+	"""
+	def __init__(self, notifyFunction=None):
+		"""
+		Initialize a notification_many handler
+
+		:param notifyFunction: 	function called with (token, message) for every notified token,
+								eg: `lambda t, m: t.enqueue(serverPackets.notification(m))`.
+								If None, notifications are dropped. Default: None
+		"""
+		super().__init__()
+		self.notifyFunction = notifyFunction
+		self.structure = {
+			"userIDs": None,
+			"filter": None,
+			"message": ""
+		}
+
+	def handle(self, data):
+		data = super().parseData(data)
+		if data is None:
+			return
+		if data["userIDs"] is not None:
+			tokens = []
+			for userID in data["userIDs"]:
+				tokens.extend(glob.tokens.getTokenFromUserID(userID, ignoreIRC=True, _all=True) or ())
+		else:
+			tokens = self.filterTokens(data["filter"])
+		for token in tokens:
+			self.notify(token, data["message"])
+
+	def filterTokens(self, filter_):
+		"""
+		Return the tokens that match a broadcast filter.
+		Only "all" (all non IRC tokens) is supported by default.
+
+		:param filter_: filter
+		:return: list of tokens
+		"""
+		if filter_ == "all":
+			return [x for x in list(glob.tokens.tokens.values()) if not x.irc]
+		return []
+
+	def notify(self, token, message):
+		"""
+		Send a notification to a token, with `notifyFunction`. Does nothing if there's no `notifyFunction`.
+
+		:param token: user token
+		:param message: notification message
+		:return:
+		"""
+		if self.notifyFunction is not None:
+			self.notifyFunction(token, message)
@@ -1,10 +1,14 @@
+import queue
 import threading
+import time
+
 from common.log import logUtils as log
-from common.redis import generalPubSubHandler
+from common.redis import generalPubSubHandler, pubSubMetrics
 from common.sentry import sentry
+from objects import glob
 
 class listener(threading.Thread):
-	def __init__(self, r, handlers):
+	def __init__(self, r, handlers, workers=0, ordering="channel", keyFunction=None, queueSize=1000, metricsInterval=10):
 		"""
 		Initialize a set of redis pubSub listeners
 
@@ -23,13 +27,39 @@ class listener(threading.Thread):
 
 		- 	A function *object (not call)* that accepts one argument, that'll be the data received through the channel.
 			This is useful if you want to make some simple handlers through a lambda, without having to create a class.
+		:param workers: 	number of threads that run the handlers.
+							0 = run the handlers in the listener thread, one message at a time. Default: 0
+		:param ordering:	how messages are ordered when `workers` > 0:
+							"channel": messages of the same channel are handled one at a time, in order
+							"key": messages with the same key (see `keyFunction`) are handled one at a time, in order
+							None: no ordering, every message is handled by the least busy worker
+							Default: "channel"
+		:param keyFunction: function that returns a message key from channel name and data.
+							Required if `ordering` is "key".
+		:param queueSize: 	max messages waiting in each worker's queue.
+							When a queue is full, the listener waits before reading other messages. Default: 1000
+		:param metricsInterval: seconds between queue depth reports to datadog. Default: 10
 		"""
 		threading.Thread.__init__(self)
+		if ordering not in ("channel", "key", None):
+			raise ValueError("Unsupported ordering ({})".format(ordering))
+		if ordering == "key" and keyFunction is None:
+			raise ValueError("keyFunction is required with key ordering")
 		self.redis = r
 		self.pubSub = self.redis.pubsub()
 		self.handlers = handlers
+		self.ordering = ordering
+		self.keyFunction = keyFunction
+		self.metricsInterval = metricsInterval
+		self.lastMetrics = 0
+		self.queues = []
+		for _ in range(workers):
+			q = queue.Queue(maxsize=queueSize)
+			self.queues.append(q)
+			threading.Thread(target=self.__workerLoop, args=(q,), daemon=True).start()
 		channels = []
 		for k, v in self.handlers.items():
+			generalPubSubHandler.checkHandler(v)
 			channels.append(k)
 		self.pubSub.subscribe(channels)
 		log.debug("Subscribed to redis pubsub channels: {}".format(channels))
@@ -37,7 +67,8 @@ class listener(threading.Thread):
 	@sentry.capture()
 	def processItem(self, item):
 		"""
-		Processes a pubSub item by calling channel's handler
+		Processes a pubSub item by calling channel's handler,
+		or by sending it to a worker if this listener has workers
 
 		:param item: incoming data
 		:return:
@@ -48,14 +79,90 @@ class listener(threading.Thread):
 			item["channel"] = item["channel"].decode("utf-8")
 
 			# Make sure the handler exists
-			if item["channel"] in self.handlers:
-				log.info("Redis pubsub: {} <- {} ".format(item["channel"], item["data"]))
-				if isinstance(self.handlers[item["channel"]], generalPubSubHandler.generalPubSubHandler):
-					# Handler class
-					self.handlers[item["channel"]].handle(item["data"])
-				else:
-					# Function
-					self.handlers[item["channel"]](item["data"])
+			if item["channel"] not in self.handlers:
+				return
+			if not self.queues:
+				self.handleItem(item)
+				return
+
+			# Pick a worker and queue the message. This blocks if the worker's queue is full.
+			if self.ordering == "channel":
+				q = self.queues[hash(item["channel"]) % len(self.queues)]
+			elif self.ordering == "key":
+				q = self.queues[hash(self.keyFunction(item["channel"], item["data"])) % len(self.queues)]
+			else:
+				q = min(self.queues, key=lambda x: x.qsize())
+			q.put((item, time.perf_counter()))
+			self.reportQueueDepth()
+
+	@sentry.capture()
+	def handleItem(self, item):
+		"""
+		Call channel's handler
+
+		:param item: incoming data, with decoded channel name
+		:return:
+		"""
+		if pubSubMetrics.shouldLog():
+			log.info("Redis pubsub: {} <- {} ".format(item["channel"], item["data"]))
+		start = time.perf_counter()
+		error = False
+		pubSubMetrics.popPublishTime()
+		try:
+			if isinstance(self.handlers[item["channel"]], generalPubSubHandler.generalPubSubHandler):
+				# Handler class
+				self.handlers[item["channel"]].handle(item["data"])
+			else:
+				# Function
+				self.handlers[item["channel"]](item["data"])
+		except:
+			error = True
+			raise
+		finally:
+			pubSubMetrics.record(
+				item["channel"],
+				len(item["data"]) if isinstance(item["data"], bytes) else 0,
+				(time.perf_counter() - start) * 1000,
+				error=error,
+				publishTime=pubSubMetrics.popPublishTime()
+			)
+
+	def __workerLoop(self, q):
+		while True:
+			item, queuedAt = q.get()
+			try:
+				self.__histogram("queue_latency", (time.perf_counter() - queuedAt) * 1000, item["channel"])
+				self.handleItem(item)
+			finally:
+				q.task_done()
+
+	def queueDepths(self):
+		"""
+		Return the number of messages waiting in each worker's queue
+
+		:return: list of ints, one per worker
+		"""
+		return [x.qsize() for x in self.queues]
+
+	def reportQueueDepth(self):
+		"""
+		Send the queue depth to datadog, at most once every `self.metricsInterval` seconds
+
+		:return:
+		"""
+		now = time.time()
+		if now - self.lastMetrics < self.metricsInterval:
+			return
+		self.lastMetrics = now
+		dog = getattr(glob, "dog", None)
+		if dog is not None:
+			dog.gauge(glob.DATADOG_PREFIX + ".pubsub.queue_depth", sum(self.queueDepths()))
+
+	@staticmethod
+	def __histogram(name, value, channel):
+		dog = getattr(glob, "dog", None)
+		if dog is not None:
+			dog.histogram(glob.DATADOG_PREFIX + ".pubsub." + name, value, tags=["channel:{}".format(channel)])
 
 	def run(self):
 		"""
@@ -65,4 +172,4 @@ class listener(threading.Thread):
 		:return:
 		"""
 		for item in self.pubSub.listen():
-			self.processItem(item)
\ No newline at end of file
+			self.processItem(item)
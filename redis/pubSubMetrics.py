@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+from objects import glob
+
+# If True, `stamp` adds the publish time to json messages, so listeners can measure the end-to-end lag.
+# Enable it only when all listeners use a generalPubSubHandler that removes the timestamp before validation.
+embedTimestamps = False
+TIMESTAMP_KEY = "__ts"
+
+# Fraction of received messages that are logged by the listeners. 1 = all messages, 0 = none.
+logSampleRate = 1.0
+
+_counters = {}
+_countersLock = threading.Lock()
+_local = threading.local()
+
+
+def stamp(data):
+	"""
+	Add the current time to a message that's about to be published, if `embedTimestamps` is True
+
+	:param data: message dictionary
+	:return: `data`, with the timestamp if enabled
+	"""
+	if embedTimestamps:
+		data[TIMESTAMP_KEY] = time.time()
+	return data
+
+def extractTimestamp(data):
+	"""
+	Remove the publish time from a received message and save it for the current thread.
+	Called by `generalPubSubHandler.parseData`.
+
+	:param data: parsed message
+	:return:
+	"""
+	if isinstance(data, dict) and TIMESTAMP_KEY in data:
+		_local.publishTime = data.pop(TIMESTAMP_KEY)
+
+def popPublishTime():
+	"""
+	Return and reset the publish time of the last message parsed by the current thread
+
+	:return: UNIX time or None if the message had no timestamp
+	"""
+	publishTime = getattr(_local, "publishTime", None)
+	_local.publishTime = None
+	return publishTime
+
+def shouldLog():
+	"""
+	Return True if the current message should be logged, according to `logSampleRate`
+
+	:return:
+	"""
+	return logSampleRate >= 1 or random.random() < logSampleRate
+
+def record(channel, size, latency, error=False, publishTime=None):
+	"""
+	Record a processed message
+
+	:param channel: channel name
+	:param size: message size, in bytes
+	:param latency: handler latency, in milliseconds
+	:param error: True if the handler raised an exception. Default: False
+	:param publishTime: publish UNIX time, if the message had one. Default: None
+	:return:
+	"""
+	with _countersLock:
+		counters = _counters.setdefault(channel, {"messages": 0, "bytes": 0, "errors": 0})
+		counters["messages"] += 1
+		counters["bytes"] += size
+		if error:
+			counters["errors"] += 1
+	dog = getattr(glob, "dog", None)
+	if dog is None:
+		return
+	tags = ["channel:{}".format(channel)]
+	prefix = glob.DATADOG_PREFIX + ".pubsub."
+	dog.increment(prefix + "messages", tags=tags)
+	dog.increment(prefix + "bytes", size, tags=tags)
+	if error:
+		dog.increment(prefix + "errors", tags=tags)
+	dog.histogram(prefix + "handler_latency", latency, tags=tags)
+	if publishTime is not None:
+		dog.histogram(prefix + "lag", (time.time() - publishTime) * 1000, tags=tags)
+
+def getCounters():
+	"""
+	Return the counters of all channels
+
+	:return: dictionary with channel names as keys and `messages`, `bytes` and `errors` counters as values
+	"""
+	with _countersLock:
+		return {k: dict(v) for k, v in _counters.items()}
@@ -0,0 +1,61 @@
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	Handler for `peppy:update_stats`, published by `common.ripple.userUtils.updateStats`.
+	Patches the cached stats of the tokens of a user with the stats received through redis,
+	so bancho doesn't have to read them back from db after a score submission.
+	Override `onStatsUpdated` to send the new stats to the clients.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.structure = {
+			"userID": 0,
+			"gameMode": 0,
+			"rankedScore": 0,
+			"totalScore": 0,
+			"accuracy": 0,
+			"pp": 0,
+			"gameRank": 0,
+			"playcount": 0
+		}
+
+	def handle(self, data):
+		data = super().parseData(data)
+		if data is None:
+			return
+		tokens = glob.tokens.getTokenFromUserID(data["userID"], ignoreIRC=True, _all=True)
+		if not tokens:
+			return
+		tokens = [x for x in tokens if x.gameMode == data["gameMode"]]
+		for token in tokens:
+			self.patchToken(token, data)
+		if tokens:
+			self.onStatsUpdated(data["userID"], tokens)
+
+	def patchToken(self, token, data):
+		"""
+		Set a token's cached stats, like `token.updateCachedStats` does
+
+		:param token: user token
+		:param data: received stats
+		:return:
+		"""
+		token.gameRank = data["gameRank"]
+		token.pp = data["pp"]
+		token.rankedScore = data["rankedScore"]
+		token.accuracy = data["accuracy"] / 100
+		token.playcount = data["playcount"]
+		token.totalScore = data["totalScore"]
+
+	def onStatsUpdated(self, userID, tokens):
+		"""
+		Called after the stats of some tokens have been patched. Does nothing by default.
+
+		:param userID: user id
+		:param tokens: list of patched tokens
+		:return:
+		"""
+		pass
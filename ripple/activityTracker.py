@@ -0,0 +1,119 @@
+import threading
+import time
+
+from common.db import periodicFlusher
+from common.log import logUtils as log
+from common.redis import batch
+from objects import glob
+
+
+class activityTracker(periodicFlusher.periodicFlusher):
+	"""
+	Users latest activity tracker.
+	Keeps the latest activity time of each user in memory or in a redis hash and writes it
+	to `phpbb_users.user_lastvisit` periodically, with a single query.
+	Each user is written at most once per flush, no matter how many times their activity is updated.
+	"""
+	flushDescription = "latest activity"
+
+	def __init__(self, backend="memory", interval=30, redisKey="ripple:latest_activity", chunkSize=500):
+		"""
+		Initialize an activity tracker
+
+		:param backend: 	"memory" to keep activity times in this process,
+							"redis" to keep them in a redis hash shared by all processes. Default: "memory"
+		:param interval: seconds between flushes. Default: 30
+		:param redisKey: name of the redis hash used by the redis backend. Default: ripple:latest_activity
+		:param chunkSize: max users per query. Default: 500
+		"""
+		if backend not in ("memory", "redis"):
+			raise ValueError("Unsupported activity tracker backend ({})".format(backend))
+		super().__init__(interval, redisKey)
+		self.backend = backend
+		self.chunkSize = chunkSize
+		self.pending = {}
+		self.flushing = {}
+		self.lock = threading.Lock()
+
+	def update(self, userID, timestamp=None):
+		"""
+		Set `userID`'s latest activity
+
+		:param userID: user id
+		:param timestamp: UNIX time. Default: current time
+		:return:
+		"""
+		if timestamp is None:
+			timestamp = int(time.time())
+		if self.backend == "redis":
+			glob.redis.hset(self.redisKey, userID, timestamp)
+			return
+		with self.lock:
+			if timestamp > self.pending.get(userID, 0):
+				self.pending[userID] = timestamp
+
+	def get(self, userID):
+		"""
+		Get `userID`'s latest activity that has not been written to db yet
+
+		:param userID: user id
+		:return: UNIX time or None if there's no activity that's more recent than the one in db
+		"""
+		if self.backend == "redis":
+			with batch.batch() as b:
+				b.hget(self.redisKey, userID)
+				b.hget(self.redisKey + ":flushing", userID)
+			values = [int(x) for x in b.results if x is not None]
+			return max(values) if values else None
+		with self.lock:
+			values = [x[userID] for x in (self.pending, self.flushing) if userID in x]
+		return max(values) if values else None
+
+	def _flush(self):
+		if self.backend == "redis":
+			self._flushRedis()
+		else:
+			self._flushMemory()
+
+	def _flushMemory(self):
+		with self.lock:
+			self.flushing, self.pending = self.pending, {}
+		committed = set()
+		try:
+			self._write(self.flushing, committed.update)
+		except:
+			# Put the activity times that haven't been written back, they'll be written on next flush
+			with self.lock:
+				for userID, timestamp in self.flushing.items():
+					if userID not in committed and timestamp > self.pending.get(userID, 0):
+						self.pending[userID] = timestamp
+			raise
+		finally:
+			with self.lock:
+				self.flushing = {}
+
+	def _flushRedis(self):
+		self._flushRedisHash(lambda raw, committed: self._write({int(k): int(v) for k, v in raw.items()}, committed))
+
+	def _write(self, data, onCommitted=None):
+		"""
+		Write some activity times to db
+
+		:param data: dictionary with user ids as keys and UNIX times as values
+		:param onCommitted: 	function called with the list of user ids of every chunk
+								after it's been written. Default: None
+		:return:
+		"""
+		items = list(data.items())
+		for i in range(0, len(items), self.chunkSize):
+			chunk = items[i:i + self.chunkSize]
+			glob.db.execute(
+				"UPDATE phpbb_users SET user_lastvisit = GREATEST(user_lastvisit, CASE user_id {}END) WHERE user_id IN %s".format(
+					"WHEN %s THEN %s " * len(chunk)
+				),
+				[x for item in chunk for x in item] + [[x[0] for x in chunk]]
+			)
+			if onCommitted is not None:
+				onCommitted([x[0] for x in chunk])
+		if items:
+			log.debug("Flushed latest activity of {} users".format(len(items)))
@@ -1,7 +1,54 @@
 import json
 
-from objects import glob
+from common.redis import batch, eventBus, pubSubMetrics
 
 
 def notification(userID, message):
-	glob.redis.publish("peppy:notification", json.dumps({"userID": userID, "message": message}))
+	eventBus.publish("peppy:notification", json.dumps(pubSubMetrics.stamp({"userID": userID, "message": message})))
+
+
+def notifyMany(userIDs, message, compact=True, chunkSize=1000):
+	"""
+	Send a notification to many users
+
+	:param userIDs: list of user ids
+	:param message: notification message
+	:param compact: 	if True, send a single `peppy:notification_many` message with all the recipients.
+						If False, send one `peppy:notification` message per user, pipelined in chunks of `chunkSize`,
+						for bancho instances without a `peppy:notification_many` handler. Default: True
+	:param chunkSize: max publishes per round trip, if `compact` is False. Default: 1000
+	:return:
+	"""
+	userIDs = list(userIDs)
+	if not userIDs:
+		return
+	if compact:
+		eventBus.publish("peppy:notification_many", json.dumps(pubSubMetrics.stamp({
+			"userIDs": userIDs,
+			"filter": None,
+			"message": message
+		})))
+		return
+	with batch.batch(maxCommands=chunkSize) as b:
+		for userID in userIDs:
+			eventBus.publish(
+				"peppy:notification",
+				json.dumps(pubSubMetrics.stamp({"userID": userID, "message": message})),
+				b
+			)
+
+
+def broadcast(filter_, message):
+	"""
+	Send a notification to all online users that match a filter.
+	Filters are resolved by bancho (see `common.redis.notificationManyHandler`).
+
+	:param filter_: recipients filter. "all" = all online users.
+	:param message: notification message
+	:return:
+	"""
+	eventBus.publish("peppy:notification_many", json.dumps(pubSubMetrics.stamp({
+		"userIDs": None,
+		"filter": filter_,
+		"message": message
+	})))
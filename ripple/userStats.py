@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import OrderedDict
+
+from common.constants import gameModes
+from objects import glob
+
+ALL_GAME_MODES = (gameModes.STD, gameModes.TAIKO, gameModes.CTB, gameModes.MANIA)
+
+
+class modeStats:
+	"""
+	User stats relative to a single game mode
+	"""
+	__slots__ = (
+		"gameMode", "rankedScore", "totalScore", "playcount", "accuracy",
+		"accuracyTotal", "accuracyCount", "pp", "gameRank", "maxCombo", "level"
+	)
+
+	def __init__(self, row):
+		"""
+		Initialize a mode stats object from a db row
+
+		:param row: row returned by `userStatsSnapshot.load`'s query
+		"""
+		self.gameMode = row["game_mode"]
+		self.rankedScore = row["ranked_score"]
+		self.totalScore = row["total_score"]
+		self.playcount = row["playcount"]
+		self.accuracy = row["accuracy"]
+		self.accuracyTotal = row["accuracy_total"]
+		self.accuracyCount = row["accuracy_count"]
+		self.pp = row["rank_score"]
+		self.gameRank = row["rank_score_index"]
+		self.maxCombo = row["max_combo"]
+		self.level = row["level"]
+
+	@property
+	def averageAccuracy(self):
+		"""
+		Accuracy calculated from accuracy_total and accuracy_count, as shown in game
+
+		:return: accuracy
+		"""
+		return float(self.accuracyTotal) / 10000.0 / max(1, self.accuracyCount)
+
+
+class userStatsSnapshot:
+	"""
+	Stats of a user in one or more game modes, loaded with a single query
+	"""
+	__slots__ = ("userID", "modes", "loadTime")
+
+	def __init__(self, userID):
+		self.userID = userID
+		self.modes = {}
+		self.loadTime = 0
+
+	def load(self, modes=ALL_GAME_MODES):
+		"""
+		Load (or reload) stats for some game modes from db
+
+		:param modes: game modes to load. Default: all game modes
+		:return: self
+		"""
+		rows = glob.db.fetchAll(
+			" UNION ALL ".join(
+				"SELECT {gameMode} AS game_mode, ranked_score, total_score, playcount, accuracy, "
+				"accuracy_total, accuracy_count, rank_score, rank_score_index, max_combo, level "
+				"FROM osu_user_stats{table} WHERE user_id = %s".format(
+					gameMode=int(x),
+					table=gameModes.getGameModeForDB(x)
+				) for x in modes
+			),
+			(self.userID,) * len(modes)
+		)
+		for gameMode in modes:
+			self.modes.pop(gameMode, None)
+		for row in rows or ():
+			self.modes[row["game_mode"]] = modeStats(row)
+		self.loadTime = time.time()
+		return self
+
+	def get(self, gameMode):
+		"""
+		Return stats relative to `gameMode`
+
+		:param gameMode: game mode number
+		:return: modeStats object or None if there are no stats for this game mode
+		"""
+		return self.modes.get(gameMode)
+
+
+class snapshotsCache:
+	"""
+	Short lived cache of userStatsSnapshot objects
+	"""
+	def __init__(self, ttl=10, maxSize=10000):
+		"""
+		Initialize a stats snapshots cache
+
+		:param ttl: seconds after which a snapshot is reloaded from db. Default: 10
+		:param maxSize: max cached snapshots. The least recently used ones are removed first. Default: 10000
+		"""
+		self.ttl = ttl
+		self.maxSize = maxSize
+		self.snapshots = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, userID):
+		"""
+		Get `userID`'s stats snapshot, loading all game modes from db if it's not cached or expired
+
+		:param userID: user id
+		:return: userStatsSnapshot object
+		"""
+		with self.lock:
+			snapshot = self.snapshots.get(userID)
+			if snapshot is not None and time.time() - snapshot.loadTime < self.ttl:
+				self.snapshots.move_to_end(userID)
+				return snapshot
+		return self.refresh(userID)
+
+	def refresh(self, userID, modes=ALL_GAME_MODES):
+		"""
+		Reload `userID`'s stats from db and cache them
+
+		:param userID: user id
+		:param modes: game modes to reload. Default: all game modes
+		:return: userStatsSnapshot object
+		"""
+		with self.lock:
+			oldSnapshot = self.snapshots.get(userID)
+		if oldSnapshot is None or len(modes) == len(ALL_GAME_MODES):
+			snapshot = userStatsSnapshot(userID).load()
+		else:
+			# Cached snapshots are never modified, so other threads can keep using them.
+			# The other game modes keep their original load time, so they still expire on time.
+			snapshot = userStatsSnapshot(userID)
+			snapshot.modes = dict(oldSnapshot.modes)
+			snapshot.load(modes)
+			snapshot.loadTime = oldSnapshot.loadTime
+		with self.lock:
+			self.snapshots[userID] = snapshot
+			self.snapshots.move_to_end(userID)
+			while len(self.snapshots) > self.maxSize:
+				self.snapshots.popitem(last=False)
+		return snapshot
+
+	def invalidate(self, userID):
+		"""
+		Remove `userID`'s snapshot from cache
+
+		:param userID: user id
+		:return:
+		"""
+		with self.lock:
+			self.snapshots.pop(userID, None)
+
+
+cache = snapshotsCache()
+
+def get(userID):
+	"""
+	Get `userID`'s stats snapshot from cache, or from db if it's not cached
+
+	:param userID: user id
+	:return: userStatsSnapshot object
+	"""
+	return cache.get(userID)
+
+def getMode(userID, gameMode):
+	"""
+	Get `userID`'s stats relative to `gameMode`
+
+	:param userID: user id
+	:param gameMode: game mode number
+	:return: modeStats object or None if there are no stats for `gameMode`
+	"""
+	return cache.get(userID).get(gameMode)
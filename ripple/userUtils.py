@@ -10,9 +10,17 @@ from common import generalUtils
 from common.constants import gameModes
 from common.constants import privileges
 from common.log import logUtils as log
-from common.ripple import passwordUtils, scoreUtils
+from common.redis import batch, bucketedHash, eventBus, memoryReport, pubSubMetrics
+from common.ripple import passwordUtils, scoreUtils, userStats, usernameIndex
 from objects import glob
 
+# userID cache ({safeUsername: userID}) and bancho sessions ({"userID:ip": 1}).
+# Both are stored in small listpack-encoded hashes rather than one key per user.
+USERID_CACHE = bucketedHash.bucketedHash("ripple:userid_cache_bucket")
+USERID_CACHE_TTL = 3600
+BANCHO_SESSIONS = bucketedHash.bucketedHash("peppy:sessions_bucket")
+BANCHO_SESSIONS_TTL = 86400
+
 
 def getUserStats(userID, gameMode, *, relax=False):
 	"""
@@ -23,21 +31,8 @@ def getUserStats(userID, gameMode, *, relax=False):
 	:param relax: if True, return relax stats, otherwise return classic stats
 	:return: dictionary with result
 	"""
-	modeForDB = gameModes.getGameModeForDB(gameMode)
-
 	# Get stats
-	stats = glob.db.fetch(
-		f"""SELECT
-		ranked_score AS rankedScore,
-		accuracy_total,
-		accuracy_count,
-		playcount,
-		total_score AS totalScore,
-		rank_score AS pp,
-		max_combo 
-		FROM osu_user_stats{modeForDB} WHERE user_id = %s LIMIT 1""",
-		(userID,)
-	)
+	stats = userStats.getMode(userID, gameMode)
 
 	if stats is None:
 		log.info("Creating new stats data for {}".format(userID))
@@ -71,13 +66,21 @@ def getUserStats(userID, gameMode, *, relax=False):
 			f"INSERT IGNORE INTO osu_user_stats_mania_7k (`user_id`, `playcount`, `x_rank_count`, `s_rank_count`, `a_rank_count`, `country_acronym`, `rank_score`, `rank_score_index`, `accuracy_new`) VALUES (%s, 0, 0, 0, 0, %s, 0, 0, 0)",
 			(userID, country,)
 		)
+		userStats.cache.invalidate(userID)
 		return getUserStats(userID, gameMode, relax=relax)
-	stats["accuracy"] = float(stats["accuracy_total"]) / 10000.0 / max(1, stats["accuracy_count"])
-	# Get game rank
-	stats["gameRank"] = getGameRank(userID, gameMode, relax=relax)
 
 	# Return stats + game rank
-	return stats
+	return {
+		"rankedScore": stats.rankedScore,
+		"accuracy_total": stats.accuracyTotal,
+		"accuracy_count": stats.accuracyCount,
+		"playcount": stats.playcount,
+		"totalScore": stats.totalScore,
+		"pp": stats.pp,
+		"max_combo": stats.maxCombo,
+		"accuracy": stats.averageAccuracy,
+		"gameRank": stats.gameRank,
+	}
 
 
 def getIDSafe(_safeUsername: str):
@@ -101,7 +104,7 @@ def getID(username):
 	"""
 	# Get userID from redis
 	usernameSafe = safeUsername(username)
-	userID = glob.redis.get("ripple:userid_cache:{}".format(usernameSafe))
+	userID = USERID_CACHE.get(usernameSafe, usernameSafe)
 
 	if userID is None:
 		# If it's not in redis, get it from mysql
@@ -112,7 +115,7 @@ def getID(username):
 			return 0
 
 		# Otherwise, save it in redis and return it
-		glob.redis.set("ripple:userid_cache:{}".format(usernameSafe), userID, 3600)	# expires in 1 hour
+		USERID_CACHE.set(usernameSafe, usernameSafe, userID, USERID_CACHE_TTL)
 		return userID
 
 	# Return userid from redis
@@ -255,6 +258,7 @@ def updateLevel(userID, gameMode=0, totalScore=0, *, relax=False):
 		"UPDATE osu_user_stats{m} SET level = %s WHERE user_id = %s LIMIT 1".format(m=mode),
 		(level, userID)
 	)
+	userStats.cache.invalidate(userID)
 
 def calculateAccuracy(userID, gameMode, *, relax=False):
 	"""
@@ -314,6 +318,7 @@ def updateAccuracy(userID, gameMode, *, relax=False):
 		),
 		(newAcc, newAcc * 100, userID)
 	)
+	userStats.cache.invalidate(userID)
 
 def updatePP(userID, gameMode, *, relax=False):
 	"""
@@ -329,6 +334,7 @@ def updatePP(userID, gameMode, *, relax=False):
 		"UPDATE osu_user_stats{} SET rank_score=%s WHERE user_id = %s LIMIT 1".format(gm),
 		(pp, userID)
 	)
+	userStats.cache.invalidate(userID)
 	updateRank(userID, gameMode, pp)
 
 
@@ -346,6 +352,7 @@ def updateRank(userID, gameMode, pp=0):
 	if res is not None:
 		# Update rank
 		glob.db.execute("UPDATE osu_user_stats{} SET rank_score_index = %s WHERE user_id = %s LIMIT 1".format(gm), (res["rank"], userID))
+		userStats.cache.invalidate(userID)
 
 
 def updateRankGlobally(gameMode):
@@ -412,8 +419,37 @@ def updateStats(userID, score_, *, relax=False):
 		updatePP(userID, score_.gameMode, relax=relax)
 		updateRankGlobally(score_.gameMode)
 
+	# Cache the new stats and send them to bancho
+	stats = userStats.cache.refresh(userID, (score_.gameMode,)).get(score_.gameMode)
+	if stats is not None:
+		publishStats(userID, stats)
+
+def publishStats(userID, stats):
+	"""
+	Send `userID`'s stats to bancho through `peppy:update_stats`,
+	so it can update the cached stats without reading them from db.
+
+	:param userID: user id
+	:param stats: `common.ripple.userStats.modeStats` object
+	:return:
+	"""
+	eventBus.publish("peppy:update_stats", json.dumps(pubSubMetrics.stamp({
+		"userID": userID,
+		"gameMode": stats.gameMode,
+		"rankedScore": stats.rankedScore,
+		"totalScore": stats.totalScore,
+		"accuracy": stats.averageAccuracy,
+		"pp": float(stats.pp),
+		"gameRank": stats.gameRank,
+		"playcount": stats.playcount
+	})))
+
 
 def incrementUserBeatmapPlaycount(userID, gameMode, beatmapID):
+	counters = getattr(glob, "counters", None)
+	if counters is not None:
+		counters.increment("osu_user_beatmap_playcount", {"user_id": userID, "beatmap_id": beatmapID}, {"playcount": 1})
+		return
 	glob.db.execute(
 		"INSERT INTO osu_user_beatmap_playcount (user_id, beatmap_id, playcount) "
 		"VALUES (%s, %s, 1) ON DUPLICATE KEY UPDATE playcount = playcount + 1",
@@ -428,8 +464,29 @@ def updateLatestActivity(userID):
 	:param userID: user id
 	:return:
 	"""
+	tracker = getattr(glob, "activityTracker", None)
+	if tracker is not None:
+		tracker.update(userID)
+		return
 	glob.db.execute("UPDATE phpbb_users SET user_lastvisit = %s WHERE user_id = %s LIMIT 1", (int(time.time()), userID))
 
+def getLatestActivity(userID):
+	"""
+	Get userID's latest activity UNIX time
+
+	:param userID: user id
+	:return: UNIX time or 0 if the user doesn't exist
+	"""
+	tracker = getattr(glob, "activityTracker", None)
+	if tracker is not None:
+		latestActivity = tracker.get(userID)
+		if latestActivity is not None:
+			return latestActivity
+	result = glob.db.fetch("SELECT user_lastvisit FROM phpbb_users WHERE user_id = %s LIMIT 1", (userID,))
+	if result is None:
+		return 0
+	return result["user_lastvisit"]
+
 def getRankedScore(userID, gameMode, *, relax=False):
 	"""
 	Get userID's ranked score relative to gameMode
@@ -439,16 +496,10 @@ def getRankedScore(userID, gameMode, *, relax=False):
 	:param relax:
 	:return: ranked score
 	"""
-	mode = scoreUtils.getGameModeForDB(gameMode)
-	result = glob.db.fetch(
-		"SELECT ranked_score FROM osu_user_stats{m} WHERE user_id = %s LIMIT 1".format(
-			m=mode
-		), (userID,)
-	)
-	if result is not None:
-		return result["ranked_score"]
-	else:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
+	return stats.rankedScore
 
 def getPP(userID, gameMode, *, relax=False):
 	"""
@@ -458,18 +509,10 @@ def getPP(userID, gameMode, *, relax=False):
 	:param gameMode: game mode number
 	:return: pp
 	"""
-
-	mode = scoreUtils.getGameModeForDB(gameMode)
-	result = glob.db.fetch(
-		"SELECT rank_score AS pp FROM osu_user_stats{m} WHERE user_id = %s LIMIT 1".format(
-			m=mode,
-		),
-		(userID,)
-	)
-	if result is not None:
-		return result["pp"]
-	else:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
+	return stats.pp
 
 def incrementReplaysWatched(userID, gameMode):
 	"""
@@ -480,6 +523,10 @@ def incrementReplaysWatched(userID, gameMode):
 	:return:
 	"""
 	mode = scoreUtils.getGameModeForDB(gameMode)
+	counters = getattr(glob, "counters", None)
+	if counters is not None:
+		counters.increment(f"osu_user_stats{mode}", {"user_id": userID}, {"replay_popularity": 1}, upsert=False)
+		return
 	glob.db.execute(
 		f"UPDATE osu_user_stats{mode} SET replay_popularity=replay_popularity+1 WHERE user_id = %s LIMIT 1",
 		(userID,)
@@ -529,8 +576,8 @@ def checkBanchoSession(userID, ip=""):
 	:return: True if there's an active bancho session, else False
 	"""
 	if ip != "":
-		return glob.redis.sismember("peppy:sessions:{}".format(userID), ip)
-	return glob.redis.exists("peppy:sessions:{}".format(userID))
+		return BANCHO_SESSIONS.get(userID, "{}:{}".format(userID, ip)) is not None
+	return BANCHO_SESSIONS.anyWithPrefix(userID, "{}:".format(userID))
 
 def is2FAEnabled(userID):
 	"""
@@ -621,11 +668,11 @@ def ban(userID):
 		(userID)
 	)
 
-	# Notify bancho about the ban
-	glob.redis.publish("peppy:ban", userID)
-
-	# Remove the user from global and country leaderboards
-	removeFromLeaderboard(userID)
+	# Notify bancho about the ban and remove the user from
+	# global and country leaderboards, in a single round trip
+	with batch.batch() as b:
+		eventBus.publish("peppy:ban", userID, b)
+		removeFromLeaderboard(userID, b)
 
 def unban(userID):
 	"""
@@ -638,7 +685,7 @@ def unban(userID):
 		"UPDATE phpbb_users SET user_type = 0 WHERE user_id = %s LIMIT 1",
 		(userID)
 	)
-	glob.redis.publish("peppy:ban", userID)
+	eventBus.publish("peppy:ban", userID)
 
 def restrict(userID):
 	"""
@@ -656,11 +703,11 @@ def restrict(userID):
 		(userID)
 	)
 
-	# Notify bancho about this ban
-	glob.redis.publish("peppy:ban", userID)
-
-	# Remove the user from global and country leaderboards
-	removeFromLeaderboard(userID)
+	# Notify bancho about this ban and remove the user from
+	# global and country leaderboards, in a single round trip
+	with batch.batch() as b:
+		eventBus.publish("peppy:ban", userID, b)
+		removeFromLeaderboard(userID, b)
 
 def unrestrict(userID):
 	"""
@@ -673,7 +720,89 @@ def unrestrict(userID):
 		"UPDATE phpbb_users SET user_warnings = 0 WHERE user_id = %s LIMIT 1",
 		(userID)
 	)
-	glob.redis.publish("peppy:ban", userID)
+	eventBus.publish("peppy:ban", userID)
+
+def banMany(userIDs, notes=None):
+	"""
+	Ban many users at once.
+	Uses one query to ban the users, one query to append the notes and
+	one redis round trip to notify bancho and clear the leaderboards.
+
+	:param userIDs: list of user ids
+	:param notes: text to append to every user's notes. Optional. Default: None
+	:return:
+	"""
+	userIDs = list(set(userIDs))
+	if not userIDs:
+		return
+	glob.db.execute(
+		"UPDATE phpbb_users SET user_type = 1 WHERE user_id IN %s",
+		(userIDs,)
+	)
+	if notes is not None:
+		appendNotesMany([(x, notes) for x in userIDs])
+	_notifyBanMany(userIDs, removeFromLeaderboards=True)
+
+def restrictMany(userIDs, notes=None):
+	"""
+	Restrict many users at once.
+	Users that are already restricted are skipped.
+
+	:param userIDs: list of user ids
+	:param notes: text to append to every restricted user's notes. Optional. Default: None
+	:return: list of user ids that have been restricted
+	"""
+	userIDs = list(set(userIDs))
+	if not userIDs:
+		return []
+	rows = glob.db.fetchAll(
+		"SELECT user_id FROM phpbb_users WHERE user_id IN %s AND user_warnings != 1",
+		(userIDs,)
+	)
+	userIDs = [x["user_id"] for x in rows] if rows else []
+	if not userIDs:
+		return []
+	glob.db.execute(
+		"UPDATE phpbb_users SET user_warnings = 1 WHERE user_id IN %s",
+		(userIDs,)
+	)
+	if notes is not None:
+		appendNotesMany([(x, notes) for x in userIDs])
+	_notifyBanMany(userIDs, removeFromLeaderboards=True)
+	return userIDs
+
+def unrestrictMany(userIDs):
+	"""
+	Unrestrict many users at once.
+
+	:param userIDs: list of user ids
+	:return:
+	"""
+	userIDs = list(set(userIDs))
+	if not userIDs:
+		return
+	glob.db.execute(
+		"UPDATE phpbb_users SET user_warnings = 0 WHERE user_id IN %s",
+		(userIDs,)
+	)
+	_notifyBanMany(userIDs)
+
+def _notifyBanMany(userIDs, removeFromLeaderboards=False):
+	"""
+	Notify bancho about some bans/restrictions and optionally
+	remove those users from global and country leaderboards, in a single redis round trip.
+	Each user gets its own `peppy:ban` message, so bancho's handler doesn't need to change.
+
+	:param userIDs: list of user ids
+	:param removeFromLeaderboards: if True, remove the users from the leaderboards too. Default: False
+	:return:
+	"""
+	countries = getCountryMany(userIDs) if removeFromLeaderboards else {}
+	with batch.batch(maxCommands=0) as b:
+		eventBus.publishMany("peppy:ban", userIDs, b)
+		if removeFromLeaderboards:
+			for userID in userIDs:
+				removeFromLeaderboard(userID, b, country=countries.get(userID, "XX"))
 
 def appendNotes(userID, notes, addNl=True, trackDate=True):
 	"""
@@ -690,6 +819,22 @@ def appendNotes(userID, notes, addNl=True, trackDate=True):
 		(userID, notes)
 	)
 
+def appendNotesMany(notes):
+	"""
+	Append notes for many users with a single query
+
+	:param notes: list of (userID, text) tuples
+	:return:
+	"""
+	if not notes:
+		return
+	glob.db.execute(
+		"INSERT INTO osu_user_banhistory (`user_id`, `reason`, `ban_status`, `period`, `banner_id`) VALUES {}".format(
+			", ".join(["(%s, %s, 0, 0, 999)"] * len(notes))
+		),
+		[x for userID, text in notes for x in (userID, text)]
+	)
+
 # Please do not use this
 # def getPrivileges(userID):
 # 	"""
@@ -761,15 +906,10 @@ def getTotalScore(userID, gameMode, *, relax=False):
 	:param relax:
 	:return: total score
 	"""
-	res = glob.db.fetch(
-		"SELECT total_score FROM osu_user_stats{m} WHERE user_id = %s LIMIT 1".format(
-			m=gameModes.getGameModeForDB(gameMode)
-		),
-		(userID,)
-	)
-	if res is None:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
-	return res["total_score"]
+	return stats.totalScore
 
 def getAccuracy(userID, gameMode, *, relax=False):
 	"""
@@ -780,13 +920,10 @@ def getAccuracy(userID, gameMode, *, relax=False):
 	:param relax:
 	:return: accuracy
 	"""
-	m=gameModes.getGameModeForDB(gameMode)
-	res = glob.db.fetch(
-		f"SELECT accuracy FROM osu_user_stats{m} WHERE user_id = %s LIMIT 1", (userID,)
-	)
-	if res is None:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
-	return res["accuracy"]
+	return stats.accuracy
 
 def getGameRank(userID, gameMode, *, relax=False):
 	"""
@@ -797,15 +934,10 @@ def getGameRank(userID, gameMode, *, relax=False):
 	:return: game rank
 	"""
 	# don't use this
-	gm = gameModes.getGameModeForDB(gameMode)
-	res = glob.db.fetch(
-		"SELECT `rank_score_index` FROM osu_user_stats{m} WHERE user_id = %s".format(
-			m=gm
-		), (userID,)
-	)
-	if res is None:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
-	return res["rank_score_index"]
+	return stats.gameRank
 	# k = "ripple:leaderboard:{}".format(gameModes.getGameModeForDB(gameMode))
 	# if relax:
 	# 	k += ":relax"
@@ -824,15 +956,48 @@ def getPlaycount(userID, gameMode, *, relax=False):
 	:param relax:
 	:return: playcount
 	"""
-	res = glob.db.fetch(
-		"SELECT playcount FROM osu_user_stats{m} WHERE user_id = %s LIMIT 1".format(
-			m=gameModes.getGameModeForDB(gameMode),
-		),
-		(userID,)
-	)
-	if res is None:
+	stats = userStats.getMode(userID, gameMode)
+	if stats is None:
 		return 0
-	return res["playcount"]
+	return stats.playcount
+
+# Friend lists are cached in redis sets (`ripple:friends:{userID}`).
+# Every cached set contains FRIENDS_CACHE_WARM_MARKER, so a set created by a write-through
+# before the cache was warmed from mysql is not mistaken for a complete friend list.
+# The TTL is set only when the cache is warmed, so a cached list is reloaded from mysql
+# at least every FRIENDS_CACHE_TTL seconds, even if it's read often.
+FRIENDS_CACHE_TTL = 3600
+FRIENDS_CACHE_WARM_MARKER = "0"
+
+def _friendsCacheKey(userID):
+	return "ripple:friends:{}".format(userID)
+
+def _warmFriendsCache(userID):
+	"""
+	Load `userID`'s friend list from db and save it in redis
+
+	:param userID: user id
+	:return: set with friends userIDs
+	"""
+	friends = glob.db.fetchAll("SELECT zebra_id FROM phpbb_zebra WHERE user_id = %s AND friend = 1", (userID,))
+	friends = {i["zebra_id"] for i in friends} if friends else set()
+	with batch.batch() as b:
+		b.sadd(_friendsCacheKey(userID), FRIENDS_CACHE_WARM_MARKER, *friends)
+		b.expire(_friendsCacheKey(userID), FRIENDS_CACHE_TTL)
+	return friends
+
+def _getCachedFriends(userID):
+	"""
+	Get `userID`'s friends from redis, warming the cache from db on cache miss
+
+	:param userID: user id
+	:return: set with friends userIDs
+	"""
+	members = {x.decode() if isinstance(x, bytes) else x for x in glob.redis.smembers(_friendsCacheKey(userID))}
+	if FRIENDS_CACHE_WARM_MARKER not in members:
+		return _warmFriendsCache(userID)
+	members.discard(FRIENDS_CACHE_WARM_MARKER)
+	return {int(x) for x in members}
 
 def getFriendList(userID):
 	"""
@@ -841,18 +1006,43 @@ def getFriendList(userID):
 	:param userID: user id
 	:return: list with friends userIDs. [0] if no friends.
 	"""
-	# Get friends from db
-	friends = glob.db.fetchAll("SELECT zebra_id FROM phpbb_zebra WHERE user_id = %s AND friend = 1", (userID,))
-
-	if friends is None or len(friends) == 0:
+	friends = _getCachedFriends(userID)
+	if not friends:
 		# We have no friends, return 0 list
 		return [0]
-	else:
-		# Get only friends
-		friends = [i["zebra_id"] for i in friends]
 
-		# Return friend IDs
-		return friends
+	# Return friend IDs
+	return list(friends)
+
+def isFriend(userID, friendID):
+	"""
+	Check if `friendID` is in `userID`'s friend list
+
+	:param userID: user id
+	:param friendID: user id to check
+	:return: True if `friendID` is a friend of `userID`, otherwise False
+	"""
+	with batch.batch() as b:
+		b.sismember(_friendsCacheKey(userID), FRIENDS_CACHE_WARM_MARKER)
+		b.sismember(_friendsCacheKey(userID), friendID)
+	warm, isMember = b.results
+	if not warm:
+		return int(friendID) in _warmFriendsCache(userID)
+	return bool(isMember)
+
+def getMutualFriends(userID, otherUserID):
+	"""
+	Get the friends that `userID` and `otherUserID` have in common
+
+	:param userID: user id
+	:param otherUserID: other user id
+	:return: list with mutual friends userIDs
+	"""
+	# Make sure both sets are warm before intersecting them
+	_getCachedFriends(userID)
+	_getCachedFriends(otherUserID)
+	mutual = glob.redis.sinter(_friendsCacheKey(userID), _friendsCacheKey(otherUserID))
+	return [int(x) for x in mutual if int(x) != int(FRIENDS_CACHE_WARM_MARKER)]
 
 def addFriend(userID, friendID):
 	"""
@@ -873,7 +1063,11 @@ def addFriend(userID, friendID):
 		glob.db.execute("INSERT INTO phpbb_zebra (user_id, zebra_id, friend, foe) VALUES (%s, %s, 1, 0)", [userID, friendID])
 	elif res["friend"] != 1:
 		# just update friend value
-		glob.db.execute("UPDATE phpbb_zebra SET friend = 1 WHERE user_id = %s, zebra_id = %s", [userID, friendID])
+		glob.db.execute("UPDATE phpbb_zebra SET friend = 1 WHERE user_id = %s AND zebra_id = %s", [userID, friendID])
+
+	# Update cached friend list, only if it's warm. A cold list gets the new friend from mysql when it's warmed.
+	if glob.redis.sismember(_friendsCacheKey(userID), FRIENDS_CACHE_WARM_MARKER):
+		glob.redis.sadd(_friendsCacheKey(userID), friendID)
 
 def removeFriend(userID, friendID):
 	"""
@@ -887,6 +1081,9 @@ def removeFriend(userID, friendID):
 	# if they were not friends and they don't want to be anymore, be it. ¯\_(ツ)_/¯
 	glob.db.execute("DELETE FROM phpbb_zebra WHERE user_id = %s AND zebra_id = %s LIMIT 1", (userID, friendID))
 
+	# Update cached friend list
+	glob.redis.srem(_friendsCacheKey(userID), friendID)
+
 
 def getCountry(userID):
 	"""
@@ -900,6 +1097,22 @@ def getCountry(userID):
 		return "XX"
 	return res["country_acronym"]
 
+def getCountryMany(userIDs):
+	"""
+	Get the country **(two letters)** of many users with a single query
+
+	:param userIDs: list of user ids
+	:return: dictionary with user ids as keys and country codes as values.
+			Users without stats are not included.
+	"""
+	if not userIDs:
+		return {}
+	rows = glob.db.fetchAll(
+		"SELECT user_id, country_acronym FROM osu_user_stats WHERE user_id IN %s",
+		(list(userIDs),)
+	)
+	return {x["user_id"]: x["country_acronym"] for x in rows} if rows else {}
+
 def setCountry(userID, country):
 	"""
 	Set userID's country
@@ -937,7 +1150,7 @@ def saveBanchoSession(userID, ip):
 	:param ip: IP address
 	:return:
 	"""
-	glob.redis.sadd("peppy:sessions:{}".format(userID), ip)
+	BANCHO_SESSIONS.set(userID, "{}:{}".format(userID, ip), 1, BANCHO_SESSIONS_TTL)
 
 def deleteBanchoSessions(userID, ip):
 	"""
@@ -947,7 +1160,40 @@ def deleteBanchoSessions(userID, ip):
 	:param ip: IP address
 	:return:
 	"""
-	glob.redis.srem("peppy:sessions:{}".format(userID), ip)
+	BANCHO_SESSIONS.delete(userID, "{}:{}".format(userID, ip))
+
+def compactRedisCaches(deleteLegacyKeys=False):
+	"""
+	Delete expired entries from the userID cache and bancho sessions.
+	Meant to be run periodically.
+
+	:param deleteLegacyKeys: 	if True, delete the `ripple:userid_cache:*` and `peppy:sessions:*` keys
+								used before the bucketed layout too. Default: False
+	:return: number of deleted entries
+	"""
+	deleted = USERID_CACHE.compact() + BANCHO_SESSIONS.compact()
+	if deleteLegacyKeys:
+		for pattern in ("ripple:userid_cache:*", "peppy:sessions:*"):
+			with batch.batch() as b:
+				for key in glob.redis.scan_iter(match=pattern, count=1000):
+					b.delete(key)
+					deleted += 1
+	log.info("Deleted {} stale userID cache and bancho sessions entries".format(deleted))
+	return deleted
+
+def getRedisCachesMemoryReport():
+	"""
+	Measure the memory used by the userID cache and bancho sessions,
+	both with the bucketed layout and with the legacy one-key-per-user layout.
+
+	:return: `common.redis.memoryReport.report` result
+	"""
+	return memoryReport.report({
+		"userid_cache": "{}:*".format(USERID_CACHE.prefix),
+		"userid_cache_legacy": "ripple:userid_cache:*",
+		"bancho_sessions": "{}:*".format(BANCHO_SESSIONS.prefix),
+		"bancho_sessions_legacy": "peppy:sessions:*",
+	})
 
 def setPrivileges(userID, priv):
 	"""
@@ -1118,7 +1364,10 @@ def logHardware(userID, hashes, activation = False):
 						hwid=hashes[2:5],
 						banned=i["username"],
 						bannedUserID=i["userid"]
-					)
+					),
+					key="hwid_restrict",
+					item="**{}** ({})".format(username, userID),
+					summary="users auto-restricted for HWID matches with banned/restricted users"
 				)
 
 	# Update hash set occurencies
@@ -1221,7 +1470,10 @@ def verifyUser(userID, hashes):
 				originalUserID=originalUserID,
 				username=username,
 				userID=userID
-			)
+			),
+			key="multiaccount",
+			item="**{}** ({}) -> **{}** ({})".format(originalUsername, originalUserID, username, userID),
+			summary="multiaccounts banned and original accounts restricted"
 		)
 
 		# Disallow login
@@ -1311,25 +1563,41 @@ def changeUsername(userID=0, oldUsername="", newUsername=""):
 		(userID, newUsername, oldUsername)
 	)
 
-	# Empty redis username cache
-	# TODO: Le pipe woo woo
-	glob.redis.delete("ripple:userid_cache:{}".format(safeUsername(oldUsername)))
-	glob.redis.delete("ripple:change_username_pending:{}".format(userID))
+	# Empty redis username cache and update usernames index
+	with batch.batch() as b:
+		USERID_CACHE.delete(safeUsername(oldUsername), safeUsername(oldUsername), b)
+		b.delete("ripple:change_username_pending:{}".format(userID))
+		usernameIndex.remove(userID, safeUsername(oldUsername), b)
+		usernameIndex.add(userID, newUsernameSafe, b)
 
-def removeFromLeaderboard(userID):
+	# Empty RAP logs username cache
+	rapLog = getattr(glob, "rapLog", None)
+	if rapLog is not None:
+		rapLog.invalidateUsername(userID)
+
+def removeFromLeaderboard(userID, b=None, country=None):
 	"""
 	Removes userID from global and country leaderboards.
 
 	:param userID:
+	:param b: 	`common.redis.batch.batch` object to queue the redis commands in.
+				If None, a new batch is created and sent right away. Default: None
+	:param country: user's country, if already known. If None, it's fetched from db. Default: None
 	:return:
 	"""
+	if b is None:
+		with batch.batch() as b:
+			return removeFromLeaderboard(userID, b, country)
+
 	# Remove the user from global and country leaderboards, for every mode
-	country = getCountry(userID).lower()
+	if country is None:
+		country = getCountry(userID)
+	country = country.lower()
 	for mode in ("std", "taiko", "ctb", "mania"):
 		for suffix in ("", ":relax"):
-			glob.redis.zrem("ripple:leaderboard:{}{}".format(mode, suffix), str(userID))
+			b.zrem("ripple:leaderboard:{}{}".format(mode, suffix), str(userID))
 			if country is not None and len(country) > 0 and country != "xx":
-				glob.redis.zrem("ripple:leaderboard:{}:{}{}".format(mode, country, suffix), str(userID))
+				b.zrem("ripple:leaderboard:{}:{}{}".format(mode, country, suffix), str(userID))
 
 # Not used / Don't use this
 # def deprecateTelegram2Fa(userID):
@@ -1377,6 +1645,15 @@ def updateTotalHits(userID=0, gameMode=gameModes.STD, newHits=0, score=None, *,
 		gameMode = score.gameMode
 		userID = score.playerUserID
 		gm=gameModes.getGameModeForDB(gameMode)
+		counters = getattr(glob, "counters", None)
+		if counters is not None:
+			counters.increment(
+				f"osu_user_stats{gm}",
+				{"user_id": userID},
+				{"count300": score.c300, "count100": score.c100, "count50": score.c50, "countMiss": score.cMiss},
+				upsert=False
+			)
+			return
 		glob.db.execute(
 			f"UPDATE osu_user_stats{gm} SET count300 = count300 + %s, count100 = count100 + %s, count50 = count50 + %s, countMiss = countMiss + %s WHERE user_id = %s LIMIT 1",
 			(score.c300, score.c100, score.c50, score.cMiss, userID)
@@ -0,0 +1,160 @@
+from common.log import logUtils as log
+from common.redis import batch
+from objects import glob
+
+# Sorted set with all safe usernames. All members have score 0,
+# so they're sorted lexicographically and we can use ZRANGEBYLEX for prefix searches.
+# Members are "{safeUsername}\x00{userID}".
+INDEX_KEY = "ripple:usernames"
+SEPARATOR = b"\x00"
+
+
+def _member(userID, safeUsername):
+	return safeUsername.encode("utf-8") + SEPARATOR + str(userID).encode("utf-8")
+
+def _parseMember(member):
+	safeUsername, userID = member.rsplit(SEPARATOR, 1)
+	return int(userID), safeUsername.decode("utf-8")
+
+def add(userID, safeUsername, b=None):
+	"""
+	Add a user to the usernames index
+
+	:param userID: user id
+	:param safeUsername: safe username
+	:param b: `common.redis.batch.batch` object to queue the command in. If None, it's sent right away. Default: None
+	:return:
+	"""
+	(b if b is not None else glob.redis).zadd(INDEX_KEY, {_member(userID, safeUsername): 0})
+
+def remove(userID, safeUsername, b=None):
+	"""
+	Remove a user from the usernames index
+
+	:param userID: user id
+	:param safeUsername: safe username
+	:param b: `common.redis.batch.batch` object to queue the command in. If None, it's sent right away. Default: None
+	:return:
+	"""
+	(b if b is not None else glob.redis).zrem(INDEX_KEY, _member(userID, safeUsername))
+
+def _range(prefix, offset, count):
+	prefix = prefix.encode("utf-8")
+	return glob.redis.zrangebylex(INDEX_KEY, b"[" + prefix, b"[" + prefix + b"\xff", start=offset, num=count)
+
+def searchPrefix(prefix, limit=10):
+	"""
+	Return the users whose safe username starts with `prefix`
+
+	:param prefix: username prefix. It's converted to a safe username.
+	:param limit: max number of results. Default: 10
+	:return: list of (userID, safeUsername) tuples, sorted by safe username
+	"""
+	from common.ripple import userUtils
+	return [_parseMember(x) for x in _range(userUtils.safeUsername(prefix), 0, limit)]
+
+def editDistance(a, b, maxDistance):
+	"""
+	Return the Levenshtein distance between `a` and `b`, if it's not greater than `maxDistance`
+
+	:param a: first string
+	:param b: second string
+	:param maxDistance: max distance
+	:return: distance or None if it's greater than `maxDistance`
+	"""
+	if abs(len(a) - len(b)) > maxDistance:
+		return None
+	previous = list(range(len(b) + 1))
+	for i, ca in enumerate(a, 1):
+		current = [i]
+		for j, cb in enumerate(b, 1):
+			current.append(min(
+				previous[j] + 1,
+				current[j - 1] + 1,
+				previous[j - 1] + (ca != cb)
+			))
+		# Every value in the next rows is >= the min of this row
+		if min(current) > maxDistance:
+			return None
+		previous = current
+	return previous[-1] if previous[-1] <= maxDistance else None
+
+def _fuzzyPrefixes(username):
+	# Two characters prefixes that most usernames close to `username` start with:
+	# same first two characters, an extra first character and an extra second character in `username`
+	prefixes = [username[:2]]
+	if len(username) >= 3:
+		prefixes.append(username[1:3])
+		prefixes.append(username[0] + username[2])
+	return list(dict.fromkeys(prefixes))
+
+def searchFuzzy(username, maxDistance=2, limit=10, maxCandidates=2000):
+	"""
+	Return the users whose safe username is at most `maxDistance` edits away from `username`.
+	To keep the number of candidates small, only usernames that start with the same two characters
+	(or with the same characters if the first or the second one of `username` is an extra character) are checked.
+	This means that typos that replace the first or the second character are not found.
+
+	:param username: username to look for. It's converted to a safe username.
+	:param maxDistance: max edit distance. Default: 2
+	:param limit: max number of results. Default: 10
+	:param maxCandidates: max number of usernames to compare. Default: 2000
+	:return: list of (userID, safeUsername) tuples, closest first
+	"""
+	from common.ripple import userUtils
+	username = userUtils.safeUsername(username)
+	if not username:
+		return []
+	results = []
+	seen = set()
+	pageSize = 500
+	prefixes = _fuzzyPrefixes(username)
+	for prefix in prefixes:
+		offset = 0
+		budget = maxCandidates // len(prefixes)
+		while offset < budget:
+			page = _range(prefix, offset, min(pageSize, budget - offset))
+			for member in page:
+				if member in seen:
+					continue
+				seen.add(member)
+				userID, candidate = _parseMember(member)
+				distance = editDistance(username, candidate, maxDistance)
+				if distance is not None:
+					results.append((distance, candidate, userID))
+			if len(page) < pageSize:
+				break
+			offset += pageSize
+	results.sort()
+	return [(userID, candidate) for _, candidate, userID in results[:limit]]
+
+def rebuild(chunkSize=10000):
+	"""
+	Rebuild the usernames index from db.
+	Users are read in chunks and the new index replaces the old one atomically.
+
+	:param chunkSize: number of users read from db per query. Default: 10000
+	:return: number of indexed users
+	"""
+	tempKey = INDEX_KEY + ":rebuild"
+	glob.redis.delete(tempKey)
+	lastUserID = 0
+	total = 0
+	# Every zadd carries a whole chunk of users, send it right away
+	with batch.batch(maxCommands=1) as b:
+		while True:
+			rows = glob.db.fetchAll(
+				"SELECT user_id, username_clean FROM phpbb_users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+				(lastUserID, chunkSize)
+			)
+			if not rows:
+				break
+			b.zadd(tempKey, {_member(x["user_id"], x["username_clean"]): 0 for x in rows})
+			lastUserID = rows[-1]["user_id"]
+			total += len(rows)
+	if total > 0:
+		glob.redis.rename(tempKey, INDEX_KEY)
+	else:
+		glob.redis.delete(INDEX_KEY)
+	log.info("Rebuilt usernames index ({} users)".format(total))
+	return total
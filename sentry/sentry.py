@@ -25,7 +25,10 @@ def capture():
 			try:
 				return func(*args, **kwargs)
 			except:
-				log.error("Unhandled exception!\n```\n{}\n{}```".format(sys.exc_info(), traceback.format_exc()))
+				# Rate limit by function and exception type, so the traceback is formatted only if it's logged
+				suppressed = log.allowLimited("{}.{}:{}".format(func.__module__, func.__qualname__, sys.exc_info()[0].__name__))
+				if suppressed is not None:
+					log.error("Unhandled exception!\n```\n{}\n{}```{}".format(sys.exc_info(), traceback.format_exc(), log.suppressedSuffix(suppressed)))
 				if glob.conf.sentry_enabled:
 					glob.application.sentry_client.captureException()
 		return wrapper
@@ -0,0 +1,43 @@
+import importlib.util
+import os
+import sys
+import types
+import unittest
+
+# This repository is used as the `common` package, and it expects the application to provide `objects.glob`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "common" not in sys.modules:
+	spec = importlib.util.spec_from_file_location("common", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+	sys.modules["common"] = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(sys.modules["common"])
+if "objects" not in sys.modules:
+	sys.modules["objects"] = types.ModuleType("objects")
+	sys.modules["objects.glob"] = sys.modules["objects"].glob = types.ModuleType("objects.glob")
+
+from common.log import logUtils as log
+
+
+class rateLimitedLoggingTestCase(unittest.TestCase):
+	def setUp(self):
+		self.logged = []
+		self.error = log.error
+		log.error = self.logged.append
+
+	def tearDown(self):
+		log.error = self.error
+
+	def test_key_is_caller_line(self):
+		line = sys._getframe().f_lineno + 1
+		log.errorLimited("call site test {}", 1)
+		key = "{}:{}:{}".format(__file__, line, "call site test {}")
+		self.assertIn(key, log.limiter.getCounters())
+		self.assertEqual(self.logged, ["call site test 1"])
+
+	def test_suppressed_after_burst(self):
+		for i in range(log.limiter.burst + 3):
+			log.errorLimited("burst test {}", i)
+		self.assertEqual(len(self.logged), log.limiter.burst)
+
+
+if __name__ == "__main__":
+	unittest.main()